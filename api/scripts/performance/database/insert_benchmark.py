@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Image insertion benchmarking script
+
+Measures the time required to add image records to the images table using
+the string-built INSERT previously used by helioviewer.jp2, the
+parameterized executemany path (insert_images) and the bulk LOAD DATA LOCAL
+INFILE path (load_images).
+
+The benchmark creates and drops an images table in the specified database,
+which should be an empty scratch database, e.g.:
+
+    CREATE DATABASE hv_benchmark;
+    insert_benchmark.py -d hv_benchmark -u user -p pass
+"""
+import os
+import sys
+import time
+import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../../../install"))
+
+from helioviewer.db import get_db_cursor, create_image_table, DatasourceCache
+from helioviewer.jp2 import insert_images, load_images
+
+# Settings
+SIZES = [10000, 100000, 1000000]
+INSERTS_PER_QUERY = 500
+ROOT_DIR = "/var/www/jp2"
+
+# Single enabled datasource so that no datasource updates are needed
+SOURCES = DatasourceCache({("SDO", "AIA", "AIA", "304"):
+                           {"id": 13, "enabled": True}})
+
+def insert_images_old(images, cursor):
+    """Original string-built INSERT implementation"""
+    query = "INSERT IGNORE INTO images VALUES "
+
+    for img in images:
+        directory, filename = os.path.split(img['filepath'])
+        path = "/" + os.path.relpath(directory, ROOT_DIR)
+        query += "(NULL, '%s', '%s', '%s', %d)," % (path, filename,
+                                                    img["date"], 13)
+
+    cursor.execute(query[:-1] + ";")
+
+def generate_images(n):
+    """Generates n AIA 304 image records"""
+    start = datetime.datetime(2011, 1, 1)
+    images = []
+
+    for i in range(n):
+        date = start + datetime.timedelta(seconds=12 * i)
+        filename = date.strftime("%Y_%m_%d__%H_%M_%S_12__SDO_AIA_AIA_304.jp2")
+        filepath = os.path.join(ROOT_DIR, "AIA", date.strftime("%Y/%m/%d"),
+                                "304", filename)
+        images.append({"filepath": filepath, "date": date,
+                       "observatory": "SDO", "instrument": "AIA",
+                       "detector": "AIA", "measurement": 304})
+
+    return images
+
+def timeit(cursor, fxn, images):
+    """Returns the time in seconds needed to insert images into an empty
+    images table"""
+    cursor.execute("DROP TABLE IF EXISTS images;")
+    create_image_table(cursor)
+
+    start = time.time()
+
+    for i in range(0, len(images), INSERTS_PER_QUERY):
+        fxn(images[i:i + INSERTS_PER_QUERY])
+
+    elapsed = time.time() - start
+
+    cursor.execute("SELECT COUNT(*) FROM images;")
+
+    if cursor.fetchone()[0] != len(images):
+        print " WARNING: wrong number of rows inserted"
+
+    return elapsed
+
+def main():
+    parser = OptionParser('%prog [options]')
+    parser.add_option('-d', '--database-name', dest='dbname',
+                      help='Scratch database to run the benchmark in')
+    parser.add_option('-u', '--database-user', dest='dbuser')
+    parser.add_option('-p', '--database-pass', dest='dbpass')
+    options = parser.parse_args()[0]
+
+    cursor = get_db_cursor(options.dbname, options.dbuser, options.dbpass,
+                           local_infile=True)
+
+    for n in SIZES:
+        images = generate_images(n)
+
+        print "[n=%d]" % n
+
+        t = timeit(cursor, lambda x: insert_images_old(x, cursor), images)
+        print " old:         %0.2fs" % t
+
+        t = timeit(cursor, lambda x: insert_images(x, SOURCES, ROOT_DIR,
+                                                   cursor, True), images)
+        print " executemany: %0.2fs" % t
+
+        # Bulk loads are done in a single step
+        cursor.execute("DROP TABLE IF EXISTS images;")
+        create_image_table(cursor)
+
+        start = time.time()
+        load_images(images, SOURCES, ROOT_DIR, cursor)
+        print " load data:   %0.2fs" % (time.time() - start)
+        print ""
+
+    cursor.execute("DROP TABLE IF EXISTS images;")
+    cursor.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+HVPull deduplication benchmarking script
+
+Measures the time required to remove duplicate files from the remote file
+lists of several servers which mirror the same data (e.g. LMSAL and JSOC).
+The quadratic implementation previously used by HVPull is only run for the
+smaller sizes.
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../../../install"))
+
+from helioviewer.hvpull.net.daemon import deduplicate
+
+# Settings
+SIZES = [1000, 10000, 100000, 1000000]
+MAX_SIZE_OLD = 10000
+NUM_SERVERS = 2
+OVERLAP = 0.9
+
+def deduplicate_old(urls):
+    """Original list-based implementation"""
+    files = [[os.path.basename(url) for url in x] for x in urls]
+
+    m = len(urls)
+    n = sum(len(x) for x in files)
+
+    counters = [0] * m
+
+    for i in range(n):
+        idx = i % m
+
+        if(len(files[idx]) > counters[idx]):
+            value = files[idx][counters[idx]]
+
+            while value is None:
+                counters[idx] += 1
+
+                if(len(files[idx]) > counters[idx]):
+                    value = files[idx][counters[idx]]
+                else:
+                    break
+
+            if value is None:
+                continue
+
+            filename = os.path.basename(value)
+
+            for i, file_list in enumerate(files):
+                if i == idx:
+                    continue
+
+                if filename in file_list:
+                    j = files[i].index(filename)
+                    files[i][j] = None
+                    urls[i][j] = None
+
+        counters[idx] += 1
+
+    new_list = []
+
+    for url_list in urls:
+        new_list.append([x for x in url_list if x is not None])
+
+    return new_list
+
+def generate_urls(n):
+    """Generates n urls spread across several servers with most of the files
+    available on each server"""
+    filenames = ["2011_11_17__%08d__SDO_AIA_AIA_304.jp2" % i
+                 for i in range(int(n / (NUM_SERVERS * OVERLAP)))]
+    urls = []
+
+    for i in range(NUM_SERVERS):
+        subset = [f for f in filenames if random.random() < OVERLAP]
+        urls.append(["http://server%d.example.com/AIA/304/%s" % (i, f)
+                     for f in subset])
+
+    return urls
+
+def timeit(fxn, urls):
+    """Returns the time in seconds needed to deduplicate a list of urls"""
+    urls = [list(x) for x in urls]
+
+    start = time.time()
+    result = fxn(urls)
+    end = time.time()
+
+    return end - start, result
+
+for n in SIZES:
+    urls = generate_urls(n)
+    total = sum(len(x) for x in urls)
+
+    t, result = timeit(deduplicate, urls)
+    unique = sum(len(x) for x in result)
+
+    print "[n=%d] unique: %d" % (total, unique)
+    print " new: %0.4fs" % t
+
+    if n <= MAX_SIZE_OLD:
+        t, expected = timeit(deduplicate_old, urls)
+        print " old: %0.4fs" % t
+
+        if [set(x) for x in result] != [set(x) for x in expected]:
+            print " WARNING: results differ from original implementation"
+
+    print ""
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+HVPull directory listing parser benchmarking script
+
+Measures the time required to extract the links from synthetic Apache
+directory index pages of various sizes, comparing the streaming URLLister
+used by HVPull with the SGMLParser-based implementation it replaced.
+"""
+import os
+import sys
+import time
+from sgmllib import SGMLParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../../../install"))
+
+from helioviewer.hvpull.browser.httpbrowser import URLLister
+
+# Settings
+SIZES = [1000, 7000, 50000]
+CHUNK_SIZE = 64 * 1024
+REPEAT = 3
+
+class SGMLURLLister(SGMLParser):
+    """Original SGMLParser-based implementation"""
+    def __init__(self):
+        SGMLParser.__init__(self)
+        self.urls = []
+
+    def reset(self):
+        SGMLParser.reset(self)
+        self.urls = []
+
+    def start_a(self, attrs):
+        href = [v for k, v in attrs if k == 'href']
+        if href:
+            self.urls.extend(href)
+
+def generate_page(n):
+    """Generates an Apache-style index page listing n AIA images"""
+    rows = ['<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">',
+            '<html><head><title>Index of /AIA/2011/11/17/304</title></head>',
+            '<body><h1>Index of /AIA/2011/11/17/304</h1><table>',
+            '<tr><th><a href="?C=N;O=D">Name</a></th>'
+            '<th><a href="?C=M;O=A">Last modified</a></th>'
+            '<th><a href="?C=S;O=A">Size</a></th></tr>',
+            '<tr><td><a href="/AIA/2011/11/17/">Parent Directory</a></td></tr>']
+
+    for i in range(n):
+        filename = "2011_11_17__%02d_%02d_%02d_12__SDO_AIA_AIA_304.jp2" % (
+            (i / 3600) % 24, (i / 60) % 60, i % 60)
+
+        # Include some unquoted links, which some servers generate
+        if i % 10 == 0:
+            href = filename
+        else:
+            href = '"%s"' % filename
+
+        rows.append('<tr><td valign="top"><img src="/icons/image2.gif" '
+                    'alt="[IMG]"></td><td><a href=%s>%s</a></td>'
+                    '<td align="right">17-Nov-2011 00:%02d  </td>'
+                    '<td align="right">1.2M</td></tr>' % (href, filename,
+                                                          i % 60))
+
+    rows.append('</table><address>Apache Server</address></body></html>')
+
+    return "\n".join(rows)
+
+def parse(cls, page):
+    """Parses a page in fixed-size chunks, as it would arrive over the
+    network, and returns the filtered list of links"""
+    lister = cls()
+
+    for i in range(0, len(page), CHUNK_SIZE):
+        lister.feed(page[i:i + CHUNK_SIZE])
+
+    lister.close()
+
+    return filter(lambda url: url and url[0] != "/" and url[0] != "?",
+                  lister.urls)
+
+def timeit(cls, page):
+    """Returns the best time in seconds needed to parse a page"""
+    best = None
+
+    for i in range(REPEAT):
+        start = time.time()
+        result = parse(cls, page)
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, result
+
+for n in SIZES:
+    page = generate_page(n)
+
+    t_new, result = timeit(URLLister, page)
+    t_old, expected = timeit(SGMLURLLister, page)
+
+    print "[n=%d] page size: %0.1f kB" % (n, len(page) / 1024.)
+    print " new: %0.4fs" % t_new
+    print " old: %0.4fs (%0.1fx)" % (t_old, t_old / t_new)
+
+    if result != expected:
+        print " WARNING: results differ from original implementation"
+
+    print ""
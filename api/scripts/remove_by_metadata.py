@@ -10,6 +10,11 @@ import remove
 import database
 from itertools import islice
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../../install"))
+
+from helioviewer.jp2 import find_images
+
 def main():
     # Connect to database
     cursor = database.get_dbcursor()
@@ -28,13 +33,14 @@ def main():
 
     filter_val = raw_input("Value: ")
 
-    # Get a list of files to search
+    # Get a list of files to search. Images in a directory are scanned as
+    # they are found.
     if os.path.isdir(input_):
         images = find_images(input_)
+        print("Scanning images in %s..." % input_)
     else:
         images = [i.rstrip() for i in open(input_)]
-    
-    print("Scanning %d images..." % len(images))
+        print("Scanning %d images..." % len(images))
     
     # Filter image list based on criterion
     quarantine = filter_images(images, filter_key, filter_op, filter_val)
@@ -116,20 +122,5 @@ def filter_images(images, filter_key, filter_op, filter_val):
     
     return filtered
 
-def find_images(path):
-    '''Searches a directory for JPEG 2000 images.
-    
-    Traverses file-tree starting with the specified path and builds a list of
-    the available images.
-    '''
-    images = []
-    
-    for root, dirs, files in os.walk(path):
-        for file_ in files:
-            if file_.endswith('.jp2'):
-                images.append(os.path.join(root, file_))
-
-    return images
-   
 if __name__ == '__main__':
     sys.exit(main())
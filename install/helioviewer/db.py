@@ -2,8 +2,29 @@
 """Helioviewer.org installer database functions"""
 import sys
 import os
-
-def setup_database_schema(adminuser, adminpass, dbname, dbuser, dbpass, mysql):
+import re
+import time
+import logging
+import threading
+
+__FILENAMES_PER_QUERY__ = 1000
+
+# MySQL client errors indicating that the server could not be reached or that
+# the connection was lost (CR_CONN_HOST_ERROR, CR_SERVER_GONE_ERROR,
+# CR_SERVER_LOST, CR_SERVER_LOST_EXTENDED)
+__MYSQL_DISCONNECT_ERRORS__ = (2003, 2006, 2013, 2055)
+
+# Statements which can safely be sent again if the connection is lost before
+# the result is known: queries, inserts which skip duplicates, and updates
+# which only assign constant values
+__IDEMPOTENT_REGEX__ = re.compile(
+    r"""^\s*(SELECT|SHOW|INSERT\s+IGNORE|REPLACE|LOAD\s+DATA\s+.*\sIGNORE\s|"""
+    r"""UPDATE\s+\w+\s+SET\s+\w+\s*=\s*(%s|\d+|'[^']*')"""
+    r"""(\s*,\s*\w+\s*=\s*(%s|\d+|'[^']*'))*\s+WHERE\s)""",
+    re.IGNORECASE | re.DOTALL)
+
+def setup_database_schema(adminuser, adminpass, dbname, dbuser, dbpass, mysql,
+                          local_infile=False):
     """Sets up Helioviewer.org database schema"""
     if mysql:
         import MySQLdb
@@ -15,7 +36,7 @@ def setup_database_schema(adminuser, adminpass, dbname, dbuser, dbpass, mysql):
     create_db(adminuser, adminpass, dbname, dbuser, dbpass, mysql, adaptor)
 
     # connect to helioviewer database
-    cursor = get_db_cursor(dbname, dbuser, dbpass, mysql)
+    cursor = get_db_cursor(dbname, dbuser, dbpass, mysql, local_infile)
 
     create_datasource_table(cursor)
     create_observatory_table(cursor)
@@ -34,8 +55,22 @@ def setup_database_schema(adminuser, adminpass, dbname, dbuser, dbpass, mysql):
 
     return cursor
 
-def get_db_cursor(dbname, dbuser, dbpass, mysql=True):
-    """Creates a database connection"""
+def get_db_cursor(dbname, dbuser, dbpass, mysql=True, local_infile=False):
+    """Creates a database connection and returns a cursor for it
+
+    If local_infile is True, MySQL connections are allowed to use LOAD DATA
+    LOCAL INFILE to bulk load images (see helioviewer.jp2.load_images).
+    """
+    return get_db_connection(dbname, dbuser, dbpass, mysql,
+                             local_infile).cursor()
+
+def get_db_connection(dbname, dbuser, dbpass, mysql=True, local_infile=False):
+    """Creates an autocommit database connection (see get_db_cursor)
+
+    Unlike cursor.connection, which is only a weak reference for MySQLdb
+    cursors, the connection returned stays open for as long as it is
+    referenced.
+    """
     if mysql:
         import MySQLdb
     else:
@@ -44,13 +79,197 @@ def get_db_cursor(dbname, dbuser, dbpass, mysql=True):
     if mysql:
         db = MySQLdb.connect(use_unicode=True, charset = "utf8",
                              host="localhost", db=dbname, user=dbuser,
-                             passwd=dbpass)
+                             passwd=dbpass, local_infile=int(local_infile))
     else:
         db = pgdb.connect(use_unicode=True, charset = "utf8", database=dbname,
                           user=dbuser, password=dbpass)
 
     db.autocommit(True)
-    return db.cursor()
+    return db
+
+class ConnectionManager:
+    """Manages database connections for a multi-threaded process
+
+    Each thread is given its own autocommit connection, which is checked
+    before use if it has been idle for a while and re-established if it has
+    been lost. Cursors returned by the manager transparently reconnect and
+    retry idempotent statements (see __IDEMPOTENT_REGEX__) when the
+    connection to the server is lost.
+    """
+    def __init__(self, dbname, dbuser, dbpass, mysql=True, local_infile=False,
+                 retries=3, delay=5, check_interval=60):
+        """Creates a new ConnectionManager
+
+        Parameters
+        ----------
+        retries : int
+            number of times to retry a statement after losing the connection,
+            or None to keep retrying until the server is available again
+        delay : int
+            number of seconds to wait between attempts
+        check_interval : int
+            number of seconds a connection may be idle before it is checked
+        """
+        self.dbname = dbname
+        self.dbuser = dbuser
+        self.dbpass = dbpass
+        self.mysql = mysql
+        self.local_infile = local_infile
+        self.retries = retries
+        self.delay = delay
+        self.check_interval = check_interval
+
+        if mysql:
+            import MySQLdb
+            self.adaptor = MySQLdb
+        else:
+            import pgdb
+            self.adaptor = pgdb
+
+        self.errors = (self.adaptor.OperationalError,
+                       self.adaptor.InterfaceError)
+
+        self._local = threading.local()
+
+    def cursor(self):
+        """Returns a cursor which uses the calling thread's connection"""
+        return ManagedCursor(self)
+
+    def connect(self):
+        """Opens a new connection for the calling thread, closing any
+        existing one, and returns it"""
+        self.close()
+
+        self._local.connection = get_db_connection(
+            self.dbname, self.dbuser, self.dbpass, self.mysql,
+            self.local_infile)
+        self._local.last_used = time.time()
+
+        return self._local.connection
+
+    def get_connection(self):
+        """Returns the calling thread's connection, connecting or
+        reconnecting if necessary"""
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            return self.connect()
+
+        # Check connections which have not been used recently
+        if (time.time() - self._local.last_used > self.check_interval and
+            not self.is_healthy(connection)):
+            logging.info("Database connection lost. Reconnecting.")
+            return self.connect()
+
+        self._local.last_used = time.time()
+
+        return connection
+
+    def is_healthy(self, connection):
+        """Checks whether a connection is still usable"""
+        try:
+            if self.mysql:
+                connection.ping()
+            else:
+                cursor = connection.cursor()
+                cursor.execute("SELECT 1;")
+                cursor.close()
+        except self.errors:
+            return False
+
+        return True
+
+    def is_disconnect(self, error):
+        """Returns True if an error indicates a lost connection"""
+        if isinstance(error, self.adaptor.InterfaceError):
+            return True
+
+        if not self.mysql:
+            return isinstance(error, self.adaptor.OperationalError)
+
+        return len(error.args) > 0 and \
+               error.args[0] in __MYSQL_DISCONNECT_ERRORS__
+
+    def close(self):
+        """Closes the calling thread's connection"""
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+
+        if connection is not None:
+            try:
+                connection.close()
+            except self.errors:
+                pass
+
+class ManagedCursor:
+    """Cursor which reconnects and retries idempotent statements when the
+    connection to the database is lost. Other cursor attributes (fetchall,
+    rowcount, etc.) are passed through to the underlying cursor."""
+    def __init__(self, manager):
+        self._manager = manager
+        self._connection = None
+        self._cursor = None
+
+    def execute(self, sql, args=None):
+        return self._call("execute", sql, args)
+
+    def executemany(self, sql, args):
+        return self._call("executemany", sql, args)
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+
+    def __getattr__(self, name):
+        if self._cursor is None:
+            raise AttributeError(name)
+        return getattr(self._cursor, name)
+
+    def _call(self, method, sql, args):
+        """Executes a statement, retrying if the connection is lost"""
+        attempts = 0
+
+        while True:
+            sent = False
+
+            try:
+                cursor = self._get_cursor()
+                sent = True
+
+                if args is None:
+                    return getattr(cursor, method)(sql)
+
+                return getattr(cursor, method)(sql, args)
+            except self._manager.errors, e:
+                # Statements which may have been executed are only sent again
+                # if doing so is safe
+                if not self._manager.is_disconnect(e) or \
+                   (sent and not __IDEMPOTENT_REGEX__.match(sql)):
+                    raise
+
+                attempts += 1
+
+                if (self._manager.retries is not None and
+                    attempts > self._manager.retries):
+                    raise
+
+                logging.warning("Unable to reach the database (%s). Will try "
+                                "again in %d seconds.", e, self._manager.delay)
+                time.sleep(self._manager.delay)
+
+                self._cursor = None
+                self._manager.close()
+
+    def _get_cursor(self):
+        """Returns a cursor for the calling thread's current connection"""
+        connection = self._manager.get_connection()
+
+        if self._cursor is None or connection is not self._connection:
+            self._connection = connection
+            self._cursor = connection.cursor()
+
+        return self._cursor
 
 def check_db_info(adminuser, adminpass, mysql):
     """Validate database login information"""
@@ -450,19 +669,97 @@ def enable_datasource(cursor, sourceId):
     """
     cursor.execute("UPDATE datasources SET enabled=1 WHERE id=%d;" % sourceId)
 
+def enable_datasources(cursor, source_ids):
+    """Enables datasources
+
+    Marks several datasources as enabled using a single query
+    """
+    source_ids = list(source_ids)
+
+    if len(source_ids) == 0:
+        return
+
+    placeholders = ", ".join(["%s"] * len(source_ids))
+    cursor.execute("UPDATE datasources SET enabled=1 WHERE id IN (%s);" %
+                   placeholders, source_ids)
+
 def update_image_table_index(cursor):
     """Updates index on images table"""
     cursor.execute("OPTIMIZE TABLE images;")
 
 def mark_as_corrupt(cursor, filename, note):
     """Adds an image to the 'corrupt' database table"""
-    sql = "INSERT INTO corrupt VALUES (NULL, NULL, '%s', '%s');" % (filename,
-                                                                    note)
+    cursor.execute("INSERT IGNORE INTO corrupt (filename, note) "
+                   "VALUES (%s, %s);", (filename, note))
 
-    cursor.execute(sql)
+def get_new_filenames(cursor, filenames, include_corrupt=True):
+    """Returns the subset of the specified filenames which are not yet present
+    in either the 'images' or 'corrupt' database tables. If include_corrupt
+    is False, only the 'images' table is checked.
+
+    Filenames are checked in batches of __FILENAMES_PER_QUERY__ using a single
+    query per batch.
+    """
+    candidates = set(filenames)
+    remaining = list(candidates)
+    known = set()
+
+    for i in range(0, len(remaining), __FILENAMES_PER_QUERY__):
+        subset = remaining[i:i + __FILENAMES_PER_QUERY__]
+
+        placeholders = ", ".join(["%s"] * len(subset))
+
+        if include_corrupt:
+            sql = ("SELECT filename FROM images WHERE filename IN (%s) UNION "
+                   "SELECT filename FROM corrupt WHERE filename IN (%s);" %
+                   (placeholders, placeholders))
+            params = subset + subset
+        else:
+            sql = ("SELECT filename FROM images WHERE filename IN (%s);" %
+                   placeholders)
+            params = subset
+
+        cursor.execute(sql, params)
+        known.update(row[0] for row in cursor.fetchall())
+
+    return candidates.difference(known)
+
+def get_known_filenames(cursor):
+    """Returns a set containing the filenames of every image in the 'images'
+    and 'corrupt' database tables."""
+    cursor.execute("SELECT filename FROM images UNION "
+                   "SELECT filename FROM corrupt;")
+
+    known = set()
+    rows = cursor.fetchmany(__FILENAMES_PER_QUERY__)
+
+    while rows:
+        known.update(row[0] for row in rows)
+        rows = cursor.fetchmany(__FILENAMES_PER_QUERY__)
+
+    return known
 
 def get_datasources(cursor):
     """Returns a list of the known datasources"""
+    # Convert results into a more easily traversable tree structure
+    tree = {}
+
+    for (obs, inst, det, meas), source in get_datasource_index(cursor).items():
+        # Build tree
+        if obs not in tree:
+            tree[obs] = {}
+        if inst not in tree[obs]:
+            tree[obs][inst] = {}
+        if det not in tree[obs][inst]:
+            tree[obs][inst][det] = {}
+        if meas not in tree[obs][inst][det]:
+            tree[obs][inst][det][meas] = source
+
+    return tree
+
+def get_datasource_index(cursor):
+    """Returns a dictionary mapping the (observatory, instrument, detector,
+    measurement) names of each known datasource to its id and status"""
     __SOURCE_ID_IDX__ = 0
     __ENABLED_IDX__ = 1
     __OBS_NAME_IDX__ = 2
@@ -486,32 +783,73 @@ def get_datasources(cursor):
             LEFT JOIN detectors
             ON datasources.detectorId=detectors.id
             LEFT JOIN measurements
-            ON datasources.measurementId=measurements.id;"""
+            ON datasources.measurementId=measurements.id
+        ORDER BY datasources.id;"""
 
     # Fetch available data-sources
     cursor.execute(sql)
-    results = cursor.fetchall()
 
-    # Convert results into a more easily traversable tree structure
-    tree = {}
+    index = {}
 
-    for source in results:
-        # Image parameters
-        obs = source[__OBS_NAME_IDX__]
-        inst = source[__INST_NAME_IDX__]
-        det = source[__DET_NAME_IDX__]
-        meas = source[__MEAS_NAME_IDX__]
-        id = int(source[__SOURCE_ID_IDX__])
-        enabled = bool(source[__ENABLED_IDX__])
+    for source in cursor.fetchall():
+        key = (source[__OBS_NAME_IDX__], source[__INST_NAME_IDX__],
+               source[__DET_NAME_IDX__], source[__MEAS_NAME_IDX__])
 
-        # Build tree
-        if obs not in tree:
-            tree[obs] = {}
-        if inst not in tree[obs]:
-            tree[obs][inst] = {}
-        if det not in tree[obs][inst]:
-            tree[obs][inst][det] = {}
-        if meas not in tree[obs][inst][det]:
-            tree[obs][inst][det][meas] = {"id": id, "enabled": enabled}
+        # If names are repeated, the first datasource is used
+        if key not in index:
+            index[key] = {"id": int(source[__SOURCE_ID_IDX__]),
+                          "enabled": bool(source[__ENABLED_IDX__])}
 
-    return tree
+    return index
+
+class DatasourceCache:
+    """Cached lookup of datasources by (observatory, instrument, detector,
+    measurement)
+
+    Datasources are loaded from the database the first time they are needed
+    and kept until the cache is invalidated. Datasources which receive their
+    first images are enabled together when the cache is flushed.
+    """
+    def __init__(self, sources=None):
+        """Creates a new DatasourceCache, optionally with a known set of
+        datasources (see get_datasource_index)"""
+        self._sources = sources
+        self._pending = set()
+
+    def get(self, cursor, obs, inst, det, meas):
+        """Returns the id and status of a datasource. If the datasource is
+        not known, the cache is reloaded once in case it was added since the
+        datasources were loaded. A KeyError is raised if it does not exist."""
+        key = (obs, inst, det, meas)
+
+        if self._sources is None or key not in self._sources:
+            self.load(cursor)
+
+        return self._sources[key]
+
+    def enable(self, source):
+        """Marks a datasource as having data. The change is written to the
+        database the next time the cache is flushed."""
+        if not source['enabled']:
+            source['enabled'] = True
+            self._pending.add(source['id'])
+
+    def flush(self, cursor):
+        """Enables any datasources which have received their first images"""
+        if len(self._pending) > 0:
+            enable_datasources(cursor, sorted(self._pending))
+            self._pending = set()
+
+    def load(self, cursor):
+        """Loads the datasources from the database"""
+        self._sources = get_datasource_index(cursor)
+
+        # Keep sources which have been enabled but not yet flushed
+        for source in self._sources.values():
+            if source['id'] in self._pending:
+                source['enabled'] = True
+
+    def invalidate(self):
+        """Discards the cached datasources so that they are reloaded the next
+        time they are needed"""
+        self._sources = None
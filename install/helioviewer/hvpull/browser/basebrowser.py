@@ -1,8 +1,9 @@
 """Base data browser definition"""
 class BaseDataBrowser:
     """BaseDataBrowser"""
-    def __init__(self, server):
+    def __init__(self, server, cache=None):
         self.server = server
+        self.cache = cache
 
     def get_directories(self, start_time, end_time):
         """Gets a list of directories to be queried for the given time range"""
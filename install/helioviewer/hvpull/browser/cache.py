@@ -0,0 +1,69 @@
+"""Persistent cache of remote directory listings"""
+import re
+import time
+import shelve
+import datetime
+import threading
+
+class ListingCache:
+    """Stores the most recent listing of each remote directory along with the
+    validators (ETag and Last-Modified) needed to make conditional requests.
+
+    Directories whose date (e.g. .../2011/11/17/304) is older than closed_age
+    days are considered closed: once they have been listed they are assumed
+    not to change and are not requested again.
+    """
+    def __init__(self, filepath, closed_age=None):
+        """Opens or creates a listing cache at the specified location"""
+        self.closed_age = closed_age
+        self._lock = threading.Lock()
+        self._db = shelve.open(filepath, protocol=2)
+
+        # Matches dates in directory paths, e.g. AIA/2011/11/17/304
+        self._date_regex = re.compile(r"/(\d{4})/(\d{2})/(\d{2})(/|$)")
+
+    def get(self, url):
+        """Returns the cached listing for a directory or None if the directory
+        has not been listed before"""
+        with self._lock:
+            return self._db.get(self._key(url))
+
+    def set(self, url, files, etag=None, last_modified=None):
+        """Stores the listing for a directory"""
+        with self._lock:
+            self._db[self._key(url)] = {
+                "files": files,
+                "etag": etag,
+                "last_modified": last_modified,
+                "time": time.time()
+            }
+            self._db.sync()
+
+    def is_closed(self, url):
+        """Returns True if the directory is old enough that it is not expected
+        to change anymore"""
+        if not self.closed_age:
+            return False
+
+        match = self._date_regex.search(url)
+
+        if match is None:
+            return False
+
+        try:
+            date = datetime.date(*[int(x) for x in match.groups()[:3]])
+        except ValueError:
+            return False
+
+        age = datetime.datetime.utcnow().date() - date
+
+        return age > datetime.timedelta(days=self.closed_age)
+
+    def close(self):
+        """Closes the cache"""
+        with self._lock:
+            self._db.close()
+
+    def _key(self, url):
+        """Returns the key to use for a url (shelve keys must be str)"""
+        return url.rstrip("/").encode("utf-8")
@@ -1,14 +1,36 @@
 """HTTP data browser"""
 import os
-import urllib
+import re
+import logging
+import urllib2
+import httplib
 import socket
-from sgmllib import SGMLParser
 from helioviewer.hvpull.browser.basebrowser import BaseDataBrowser, NetworkError
+from helioviewer.hvpull.net.connection import ConnectionPool
+
+__CHUNK_SIZE__ = 64 * 1024
+
+# Matches the href attribute of an anchor tag. Unquoted values must be
+# followed by their terminator so that a value split between two chunks of a
+# page is not matched early.
+__HREF_REGEX__ = re.compile(r"""<a\s+(?:[^>]*?\s)?href\s*=\s*"""
+                            r"""(?:"([^"]*)"|'([^']*)'|"""
+                            r"""([^\s>"']+)(?=[\s>]))""",
+                            re.IGNORECASE)
+
+__ENTITIES__ = [("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'),
+                ("&#39;", "'"), ("&amp;", "&")]
 
 class HTTPDataBrowser(BaseDataBrowser):
-    def __init__(self, server):
-        BaseDataBrowser.__init__(self, server)
+    def __init__(self, server, cache=None, pool=None):
+        BaseDataBrowser.__init__(self, server, cache)
         socket.setdefaulttimeout(60)
+
+        # Keep-alive connections, shared with the downloaders if specified
+        if pool is None:
+            pool = ConnectionPool()
+
+        self.pool = pool
         
     def get_directories(self, start_date, end_date):
         """Generates a list of remote directories which may be queried
@@ -29,56 +51,149 @@ class HTTPDataBrowser(BaseDataBrowser):
             try:
                 files = filter(lambda url: url.endswith("." + extension), 
                                self._query(location))
-            except IOError, e:
-                if isinstance(e.strerror, socket.error):
-                    # if server is unreachable, raise an exception
-                    raise NetworkError()
-                elif isinstance(e.strerror, socket.timeout):
+            except urllib2.HTTPError, e:
+                if e.code != 404:
+                    # e.g. 500 or 503 from a mirror: skip the directory for
+                    # now rather than treat it as empty
+                    logging.warning("(%s) Unable to list %s (HTTP %d). "
+                                    "Skipping directory.", self.server.name,
+                                    location, e.code)
+
+                # 404 - no files are there
+                files = []
+            except urllib2.URLError, e:
+                if isinstance(e.reason, socket.timeout):
                     # for socket timeouts, retry
                     num_retries += 1
                     continue
                 else:
-                    # 404 - no files are there
-                    files = []
+                    # if server is unreachable, raise an exception
+                    raise NetworkError()
+            except (socket.timeout, httplib.HTTPException):
+                # timeouts and truncated responses (e.g. IncompleteRead)
+                num_retries += 1
+                continue
+            except IOError:
+                raise NetworkError()
 
         return files
     
     def _query(self, location):
-        """Get a list of files and folders at the specified remote location"""
+        """Get a list of files and folders at the specified remote location
+
+        If a listing cache is in use, previously listed directories are
+        requested conditionally and the cached listing is reused if the
+        directory has not changed. Closed directories are not requested.
+        """
+        cached = None
+        headers = {}
+
+        if self.cache is not None:
+            cached = self.cache.get(location)
+
+            if cached is not None:
+                if self.cache.is_closed(location):
+                    return cached['files']
+                if cached['etag']:
+                    headers["If-None-Match"] = cached['etag']
+                if cached['last_modified']:
+                    headers["If-Modified-Since"] = cached['last_modified']
+
         # query the remote location for the list of files and subdirectories 
+        try:
+            response = self.pool.urlopen(location, headers)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and cached is not None:
+                return cached['files']
+
+            # Fall back on the last listing if the server has a problem
+            if e.code >= 500 and cached is not None:
+                logging.warning("(%s) Unable to list %s (HTTP %d). Using "
+                                "cached listing.", self.server.name,
+                                location, e.code)
+                return cached['files']
+            raise
+
+        # Parse the listing as it arrives. The response must be closed even
+        # if reading fails so that its connection slot is released.
         url_lister = URLLister()
-        result = url_lister.read(location)
+
+        try:
+            chunk = response.read(__CHUNK_SIZE__)
+
+            while chunk:
+                url_lister.feed(chunk)
+                chunk = response.read(__CHUNK_SIZE__)
+
+            info = response.info()
+        finally:
+            response.close()
+
         url_lister.close()
 
-        urls = filter(lambda url: url[0] != "/" and url[0] != "?", result)
-        
-        return [os.path.join(location, url) for url in urls]
+        urls = filter(lambda url: url and url[0] != "/" and url[0] != "?",
+                      url_lister.urls)
+        files = [os.path.join(location, url) for url in urls]
+
+        if self.cache is not None:
+            self.cache.set(location, files, info.getheader("ETag"),
+                           info.getheader("Last-Modified"))
+
+        return files
     
-class URLLister(SGMLParser):
+class URLLister:
     '''
     Created on Nov 1, 2011
     @author: Jack Ireland <jack.ireland@nasa.gov>
     copied from the original version of the download code.
+
+    Extracts the href of each anchor in a directory listing. Data may be
+    passed in as it arrives; a tag which is split between two calls to feed
+    is kept until the rest of it is available.
     '''
     def __init__(self):
         """Create a new URLLister"""
-        SGMLParser.__init__(self)
-        self.urls = []
+        self.reset()
 
-    def read(self, uri):
-        """Read a URI and return a list of files/directories"""
-        usock = urllib.urlopen(uri)
-        self.feed(usock.read())
-        usock.close()
-        
-        return self.urls
-        
     def reset(self):
         """Reset state of URLLister"""
-        SGMLParser.reset(self)
         self.urls = []
+        self._buffer = ""
+
+    def feed(self, data):
+        """Extracts the links from the next piece of a page"""
+        data = self._buffer + data
+        end = 0
+
+        for match in __HREF_REGEX__.finditer(data):
+            href = match.group(1)
+
+            if href is None:
+                href = match.group(2)
+            if href is None:
+                href = match.group(3)
+
+            self.urls.append(_unescape(href))
+            end = match.end()
+
+        # Keep the last tag in case it is incomplete
+        start = data.rfind("<", end)
+
+        if start == -1:
+            self._buffer = ""
+        else:
+            self._buffer = data[start:]
+
+    def close(self):
+        """Finishes parsing the page"""
+        self._buffer = ""
+
+def _unescape(value):
+    """Replaces the character entities which may appear in a link"""
+    if "&" not in value:
+        return value
+
+    for entity, char in __ENTITIES__:
+        value = value.replace(entity, char)
 
-    def start_a(self, attrs):
-        href = [v for k, v in attrs if k == 'href']
-        if href:
-            self.urls.extend(href)
+    return value
@@ -5,8 +5,8 @@ from helioviewer.hvpull.browser.basebrowser import BaseDataBrowser
 class LocalDataBrowser(BaseDataBrowser):
     """Methods for finding lists of directories and files on a local file
     system."""
-    def __init__(self, server):
-        BaseDataBrowser.__init__(self, server)
+    def __init__(self, server, cache=None, pool=None):
+        BaseDataBrowser.__init__(self, server, cache)
 
     def get_directories(self,start_date, end_date):
         """Get a list of directories at the passed uri"""
@@ -4,18 +4,33 @@ import logging
 import threading
 import time
 import shutil
+from helioviewer.hvpull import metrics
 
 class LocalFileMove(threading.Thread):
-    def __init__(self, incoming, queue):
+    def __init__(self, incoming, queue, callback=None, pool=None,
+                 limiter=None, retries=None):
         """Creates a new LocalFileMover"""
         threading.Thread.__init__(self)
         
         self.shutdown_requested = False
         self.incoming = incoming
         self.queue = queue
+        self.callback = callback
+
+        # Schedules failed transfers to be retried later
+        self.retries = retries
 
     def stop(self):
         self.shutdown_requested = True
+
+    def _retry(self, server, percent, url, reason):
+        """Tries a failed transfer again later"""
+        if self.retries is None:
+            logging.warning("Failed to move %s. Adding to end of queue to retry later.", url)
+            self.queue.put([server, percent, url])
+        elif self.retries.retry(self.queue, [server, percent, url], url,
+                                reason):
+            logging.warning("Failed to move %s. Will retry later.", url)
     
     def run(self):
         """Downloads the file at the specified URI"""
@@ -39,12 +54,23 @@ class LocalFileMove(threading.Thread):
                 t1 = time.time()
                 shutil.move(uri, filepath)
                 t2 = time.time()
+                metrics.DOWNLOAD_SECONDS.observe(t2 - t1, server=server)
                 logging.info("(%s) locally moved %s to %s", server, uri, filepath)
-            except IOError:
-                # If download fails, add back into queue and try again later
-                logging.warning("Failed to move %s. Adding to end of queue to retry later.", uri)
-                self.queue.put([server, percent, uri])
+            except IOError, e:
+                # If move fails, try again later
+                metrics.DOWNLOADS.inc(server=server, status="error")
+                self._retry(server, percent, uri, str(e))
             except:
                 logging.warning("Failed to move %s.", uri)
+                metrics.DOWNLOADS.inc(server=server, status="error")
+            else:
+                metrics.DOWNLOADS.inc(server=server, status="ok")
+
+                if self.retries is not None:
+                    self.retries.succeeded(uri)
+
+                # Pass moved file on to the next stage
+                if self.callback is not None:
+                    self.callback(server, uri, filepath)
             self.queue.task_done()
     
\ No newline at end of file
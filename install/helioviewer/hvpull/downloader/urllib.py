@@ -1,21 +1,50 @@
 """urllib2-based file downloader"""
 import os
+import json
 import logging
 import threading
 import time
-from urllib2 import urlopen, Request, URLError, HTTPError
+import httplib
+from urllib2 import URLError, HTTPError
+from helioviewer.hvpull.net.connection import ConnectionPool
+from helioviewer.hvpull import metrics
+
+__CHUNK_SIZE__ = 64 * 1024
 
 class URLLibDownloader(threading.Thread):
-    def __init__(self, incoming, queue):
+    def __init__(self, incoming, queue, callback=None, pool=None,
+                 limiter=None, retries=None):
         """Creates a new URLLibDownloader"""
         threading.Thread.__init__(self)
         
         self.shutdown_requested = False
         self.incoming = incoming
         self.queue = queue
+        self.callback = callback
+
+        # Schedules failed transfers to be retried later
+        self.retries = retries
+
+        # Keep-alive connections, shared with other threads if specified
+        if pool is None:
+            pool = ConnectionPool()
+
+        self.pool = pool
+
+        # Limits the number of simultaneous downloads from the server
+        self.limiter = limiter
 
     def stop(self):
         self.shutdown_requested = True
+
+    def _retry(self, server, percent, url, reason):
+        """Tries a failed transfer again later"""
+        if self.retries is None:
+            logging.warning("Failed to download %s. Adding to end of queue to retry later.", url)
+            self.queue.put([server, percent, url])
+        elif self.retries.retry(self.queue, [server, percent, url], url,
+                                reason):
+            logging.warning("Failed to download %s. Will retry later.", url)
     
     def run(self):
         """Downloads the file at the specified URL"""
@@ -35,33 +64,192 @@ class URLLibDownloader(threading.Thread):
                 except OSError:
                     pass
     
+            # Download to a temporary file which is renamed once complete.
+            # Partial downloads are kept so that they can be resumed.
+            tmp = filepath + ".part"
+
+            # Wait until another download from this server is allowed
+            if self.limiter is not None:
+                self.limiter.acquire()
+
+            num_bytes = 0
+            failed = True
+
             #Write to our local file
             try:
-                # TODO: should urlretrieve be used instead?
                 t1 = time.time()
                 
-                remote_file = urlopen(Request(url))
-                
-                file_contents = remote_file.read()
+                num_bytes = self._download(url, tmp)
                 
                 t2 = time.time()
+
+                metrics.DOWNLOAD_SECONDS.observe(t2 - t1, server=server)
+                metrics.DOWNLOADED_BYTES.inc(num_bytes, server=server)
                 
-                mbps = (len(file_contents) / 10e5) / (t2 - t1)
+                mbps = (num_bytes / 10e5) / (t2 - t1)
                 logging.info("(%s) Downloaded %s (%0.3f MB/s) [%0.2f%%]", server, url, mbps, percent)
                 
-            except URLError:
-                # If download fails, add back into queue and try again later
-                logging.warning("Failed to download %s. Adding to end of queue to retry later.", url)
-                self.queue.put([server, percent, url])
+            except HTTPError, e:
+                # Requested range is invalid; discard partial download
+                if e.code == 416:
+                    self._remove(tmp)
+
+                self._retry(server, percent, url, "HTTP %d" % e.code)
+            except (URLError, IOError, httplib.HTTPException), e:
+                # If download fails, try again later
+                self._retry(server, percent, url, str(e))
             except:
                 logging.warning("Failed to download %s.", url)
+                self._remove(tmp)
             else:
-                # Open our local file for writing
-                # @TODO: handle full disk scenario:
-                # IOError: [Errno 28] No space left on device
-                local_file = open(filepath, "wb")
-                local_file.write(file_contents)
-                local_file.close()            
+                failed = False
+
+                if self.retries is not None:
+                    self.retries.succeeded(url)
+
+                os.rename(tmp, filepath)
+                os.remove(tmp + ".json")
+
+                # Pass finished file on to the next stage
+                if self.callback is not None:
+                    self.callback(server, url, filepath)
+
+            metrics.DOWNLOADS.inc(server=server,
+                                  status="error" if failed else "ok")
+
+            if self.limiter is not None:
+                self.limiter.release(num_bytes, failed)
             
             self.queue.task_done()
-    
\ No newline at end of file
+
+    def _download(self, url, filepath):
+        """Downloads a file, resuming a previous partial download if possible,
+        and returns the number of bytes transferred.
+
+        A JSON marker (filepath + ".json") records the url, validators and
+        expected size of a partial download. If one exists for the same url,
+        only the remaining bytes are requested using a Range request.
+        """
+        marker = self._read_marker(filepath)
+        headers = {}
+        offset = 0
+
+        if (marker is not None and marker.get('url') == url and
+            os.path.isfile(filepath)):
+            offset = os.path.getsize(filepath)
+            validator = marker.get('etag') or marker.get('last_modified')
+
+            if offset > 0 and validator:
+                headers['Range'] = "bytes=%d-" % offset
+                headers['If-Range'] = validator
+            else:
+                offset = 0
+
+        remote_file = self.pool.urlopen(url, headers)
+
+        # The response is always closed so that its connection slot is
+        # released, even if the download fails part way through
+        try:
+            # Server may ignore the range or the file may have changed
+            if remote_file.status == 206:
+                start, length = self._parse_content_range(
+                    remote_file.getheader("Content-Range"))
+
+                if start != offset:
+                    raise HTTPError(url, 416, "Unexpected Content-Range",
+                                    remote_file.info(), None)
+            else:
+                offset = 0
+                length = remote_file.getheader("Content-Length")
+
+                if length is not None:
+                    length = int(length)
+
+            self._write_marker(filepath, {
+                "url": url,
+                "etag": remote_file.getheader("ETag"),
+                "last_modified": remote_file.getheader("Last-Modified"),
+                "length": length
+            })
+
+            num_bytes = self._write(remote_file, filepath, offset > 0)
+        finally:
+            remote_file.close()
+
+        # Make sure that the complete file was received
+        if length is not None and os.path.getsize(filepath) != length:
+            raise IncompleteDownload("%s: expected %d bytes, got %d" % (
+                url, length, os.path.getsize(filepath)))
+
+        return num_bytes
+
+    def _parse_content_range(self, content_range):
+        """Parses a Content-Range header (e.g. "bytes 100-199/200") and returns
+        the first byte position and the complete length of the file"""
+        try:
+            byte_range, length = content_range.split(" ")[1].split("/")
+            start = int(byte_range.split("-")[0])
+            length = None if length == "*" else int(length)
+        except (AttributeError, IndexError, ValueError):
+            raise httplib.HTTPException("Invalid Content-Range: %s" %
+                                        content_range)
+
+        return start, length
+
+    def _read_marker(self, filepath):
+        """Reads the marker for a partial download, if one exists"""
+        try:
+            fp = open(filepath + ".json")
+        except IOError:
+            return None
+
+        try:
+            return json.load(fp)
+        except ValueError:
+            return None
+        finally:
+            fp.close()
+
+    def _write_marker(self, filepath, info):
+        """Writes the marker for a partial download"""
+        fp = open(filepath + ".json", "w")
+        json.dump(info, fp)
+        fp.close()
+
+    def _write(self, remote_file, filepath, append=False):
+        """Streams a remote file to disk in fixed-size chunks and returns the
+        number of bytes written"""
+        # @TODO: handle full disk scenario:
+        # IOError: [Errno 28] No space left on device
+        num_bytes = 0
+
+        local_file = open(filepath, "ab" if append else "wb")
+
+        try:
+            chunk = remote_file.read(__CHUNK_SIZE__)
+
+            while chunk:
+                local_file.write(chunk)
+                num_bytes += len(chunk)
+                chunk = remote_file.read(__CHUNK_SIZE__)
+
+            # Make sure file is on disk before it is renamed
+            local_file.flush()
+            os.fsync(local_file.fileno())
+        finally:
+            local_file.close()
+
+        return num_bytes
+
+    def _remove(self, filepath):
+        """Removes a partially downloaded file and its marker"""
+        for path in [filepath, filepath + ".json"]:
+            if os.path.isfile(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+class IncompleteDownload(IOError):
+    """Exception to raise when fewer bytes are received than expected"""
+    pass
@@ -0,0 +1,296 @@
+"""HVPull instrumentation
+
+Counters, gauges and latency histograms describing each stage of HVPull
+(directory listing, download, header parsing, transcoding, archiving and
+database insertion). Metrics are rendered in the Prometheus text exposition
+format and can either be served over HTTP or written periodically to a text
+file (e.g. for the node_exporter textfile collector).
+"""
+import os
+import time
+import logging
+import threading
+import BaseHTTPServer
+
+# Default histogram buckets (seconds)
+__BUCKETS__ = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, 120, 300)
+
+class Registry:
+    """A collection of metrics which can be rendered together"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        """Adds a metric to the registry and returns it"""
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Adds a function to call before rendering, e.g. to update gauges
+        whose values are cheaper to read on demand"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics)
+
+        for collector in collectors:
+            try:
+                collector()
+            except Exception, e:
+                logging.warning("Unable to collect metrics: %s", e)
+
+        lines = []
+
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+class Metric:
+    """Base class for a metric with an optional set of labels"""
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        """Returns the label values for a sample in a fixed order"""
+        try:
+            return tuple(str(labels[label]) for label in self.labels)
+        except KeyError, e:
+            raise ValueError("%s: missing label %s" % (self.name, e))
+
+    def render(self):
+        """Returns the lines describing the metric"""
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+
+        with self._lock:
+            samples = sorted(self._values.items())
+
+        for key, value in samples:
+            lines.extend(self._render_sample(key, value))
+
+        return lines
+
+    def _render_sample(self, key, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.labels, key),
+                             _format_value(value))]
+
+class Counter(Metric):
+    """A value which only increases, e.g. the number of files downloaded"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """A value which can go up and down, e.g. the length of a queue"""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    """Counts observations (e.g. durations) in cumulative buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=__BUCKETS__):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0
+                }
+
+            sample = self._values[key]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample["buckets"][i] += 1
+
+            sample["sum"] += value
+            sample["count"] += 1
+
+    def _render_sample(self, key, value):
+        lines = []
+        names = self.labels + ("le",)
+
+        for bound, count in zip(self.buckets, value["buckets"]):
+            labels = _format_labels(names, key + (_format_value(bound),))
+            lines.append("%s_bucket%s %d" % (self.name, labels, count))
+
+        labels = _format_labels(names, key + ("+Inf",))
+        lines.append("%s_bucket%s %d" % (self.name, labels, value["count"]))
+
+        labels = _format_labels(self.labels, key)
+        lines.append("%s_sum%s %s" % (self.name, labels,
+                                      _format_value(value["sum"])))
+        lines.append("%s_count%s %d" % (self.name, labels, value["count"]))
+
+        return lines
+
+def _format_labels(names, values):
+    """Formats a set of labels, e.g. {server="LMSAL",status="ok"}"""
+    if len(names) == 0:
+        return ""
+
+    pairs = []
+
+    for name, value in zip(names, values):
+        value = value.replace("\\", "\\\\").replace("\n", "\\n")
+        pairs.append('%s="%s"' % (name, value.replace('"', '\\"')))
+
+    return "{%s}" % ",".join(pairs)
+
+def _format_value(value):
+    """Formats a sample value"""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class MetricsServer(threading.Thread):
+    """Serves the metrics in a registry over HTTP at /metrics"""
+    def __init__(self, registry, port, address="127.0.0.1"):
+        threading.Thread.__init__(self)
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = registry.render()
+
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((address, port), Handler)
+
+    def stop(self):
+        self.server.shutdown()
+
+    def run(self):
+        self.server.serve_forever()
+
+class MetricsWriter(threading.Thread):
+    """Periodically writes the metrics in a registry to a text file"""
+    def __init__(self, registry, filepath, interval=15):
+        threading.Thread.__init__(self)
+
+        self.shutdown_requested = False
+        self.registry = registry
+        self.filepath = filepath
+        self.interval = interval
+
+    def stop(self):
+        self.shutdown_requested = True
+
+    def write(self):
+        """Writes the current metrics, replacing the file atomically so that
+        readers never see a partially written file"""
+        tmp = self.filepath + ".tmp"
+
+        fp = open(tmp, "w")
+        fp.write(self.registry.render())
+        fp.close()
+
+        os.rename(tmp, self.filepath)
+
+    def run(self):
+        while not self.shutdown_requested:
+            try:
+                self.write()
+            except (IOError, OSError), e:
+                logging.warning("Unable to write metrics to %s: %s",
+                                self.filepath, e)
+
+            for i in range(self.interval): #pylint: disable=W0612
+                if self.shutdown_requested:
+                    break
+                time.sleep(1)
+
+# Default registry and HVPull metrics
+REGISTRY = Registry()
+
+LISTING_SECONDS = REGISTRY.register(Histogram(
+    "hvpull_listing_duration_seconds",
+    "Time taken to list a remote directory", ["server"]))
+
+LISTINGS = REGISTRY.register(Counter(
+    "hvpull_listings_total",
+    "Number of remote directory listings", ["server", "status"]))
+
+DOWNLOAD_SECONDS = REGISTRY.register(Histogram(
+    "hvpull_download_duration_seconds",
+    "Time taken to download a single file", ["server"]))
+
+DOWNLOADS = REGISTRY.register(Counter(
+    "hvpull_downloads_total",
+    "Number of download attempts", ["server", "status"]))
+
+DOWNLOADED_BYTES = REGISTRY.register(Counter(
+    "hvpull_downloaded_bytes_total",
+    "Number of bytes downloaded", ["server"]))
+
+INGEST_SECONDS = REGISTRY.register(Histogram(
+    "hvpull_ingest_duration_seconds",
+    "Time taken by ingest stages which process one file at a time (move)",
+    ["stage"]))
+
+INGEST_BATCH_SECONDS = REGISTRY.register(Histogram(
+    "hvpull_ingest_batch_duration_seconds",
+    "Time taken by ingest stages which process a batch of files at once "
+    "(header, transcode and db_insert)", ["stage"]))
+
+INGESTED_FILES = REGISTRY.register(Counter(
+    "hvpull_ingested_files_total",
+    "Number of files processed by each ingest stage", ["stage", "status"]))
+
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "hvpull_queue_depth",
+    "Number of files waiting in each download or ingest queue", ["queue"]))
+
+DATA_LAG = REGISTRY.register(Gauge(
+    "hvpull_data_lag_seconds",
+    "Time since the observation date of the newest image ingested for each "
+    "datasource", ["datasource"]))
+
+def observe_batch(stage, elapsed, num_files):
+    """Records the time taken by an ingest stage to process a non-empty batch
+    of files"""
+    if num_files > 0:
+        INGEST_BATCH_SECONDS.observe(elapsed, stage=stage)
@@ -0,0 +1,108 @@
+"""Adaptive download concurrency
+
+Each server has a fixed number of downloader threads; an AdaptiveLimiter
+decides how many of them may be downloading at once. The limit is adjusted
+using additive-increase/multiplicative-decrease (AIMD) based on the measured
+aggregate throughput and error rate for the server.
+"""
+import time
+import logging
+import threading
+
+class AdaptiveLimiter:
+    """Limits the number of simultaneous downloads from a single server"""
+    def __init__(self, name, minimum, maximum, window=20, max_error_rate=0.1,
+                 tolerance=0.1, decrease=0.5):
+        """Creates a new AdaptiveLimiter
+
+        Parameters
+        ----------
+        name : string
+            name of the server (used for logging)
+        minimum : int
+            minimum number of simultaneous downloads
+        maximum : int
+            maximum number of simultaneous downloads
+        window : int
+            number of completed downloads between adjustments
+        max_error_rate : float
+            fraction of failed downloads above which the limit is decreased
+        tolerance : float
+            fractional drop in throughput above which the limit is decreased
+        decrease : float
+            factor by which the limit is multiplied when decreasing it
+        """
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.tolerance = tolerance
+        self.decrease = decrease
+
+        self.limit = float(self.minimum)
+        self.active = 0
+
+        self._cond = threading.Condition()
+        self._last_throughput = None
+        self._reset_window()
+
+    def acquire(self):
+        """Waits until another download may be started"""
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+            # Measurement windows start with the first download
+            if self._start is None:
+                self._start = time.time()
+
+    def release(self, num_bytes=0, error=False):
+        """Records the outcome of a download and frees its slot"""
+        with self._cond:
+            self.active -= 1
+            self._bytes += num_bytes
+            self._samples += 1
+
+            if error:
+                self._errors += 1
+
+            if self._samples >= self.window:
+                self._adjust()
+
+            self._cond.notify_all()
+
+    def _adjust(self):
+        """Adjusts the limit using the statistics for the current window"""
+        elapsed = max(time.time() - (self._start or time.time()), 1e-6)
+        throughput = self._bytes / elapsed
+        error_rate = float(self._errors) / self._samples
+
+        previous = int(self.limit)
+
+        if error_rate > self.max_error_rate:
+            # Server is struggling: back off
+            self.limit = max(self.minimum, self.limit * self.decrease)
+        elif (self._last_throughput is not None and
+              throughput < self._last_throughput * (1 - self.tolerance)):
+            # Additional streams made things worse: back off
+            self.limit = max(self.minimum, self.limit * self.decrease)
+        else:
+            # Probe for more capacity
+            self.limit = min(self.maximum, self.limit + 1)
+
+        if int(self.limit) != previous:
+            logging.info("(%s) Adjusted download concurrency %d -> %d "
+                         "(%0.3f MB/s, %d%% errors)", self.name, previous,
+                         int(self.limit), throughput / 10e5, error_rate * 100)
+
+        self._last_throughput = throughput
+        self._reset_window()
+
+    def _reset_window(self):
+        """Starts a new measurement window"""
+        self._start = None
+        self._bytes = 0
+        self._samples = 0
+        self._errors = 0
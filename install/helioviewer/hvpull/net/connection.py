@@ -0,0 +1,204 @@
+"""Persistent HTTP connection pool
+
+Keeps a bounded number of keep-alive connections open to each remote host so
+that directory listings and file downloads do not each pay for a new TCP
+connection. The pool is shared by the data browsers and downloaders.
+"""
+import select
+import socket
+import httplib
+import urlparse
+import threading
+from urllib2 import HTTPError, URLError
+
+class ConnectionPool:
+    """A thread-safe pool of HTTP keep-alive connections"""
+    def __init__(self, maxsize=8, timeout=60):
+        """Creates a new ConnectionPool
+
+        Parameters
+        ----------
+        maxsize : int
+            maximum number of connections to any single host
+        timeout : int
+            socket timeout in seconds
+        """
+        self.maxsize = maxsize
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def urlopen(self, url, headers=None, max_redirects=5):
+        """Requests a URL, following redirects, and returns the response
+
+        The connection is returned to the pool once the response has been read
+        in full and closed. As with urllib2.urlopen, an HTTPError is raised
+        for unsuccessful responses and a URLError if the host is unreachable.
+        """
+        for i in range(max_redirects + 1): #pylint: disable=W0612
+            response = self._request(url, headers or {})
+
+            if (response.status in (301, 302, 303, 307) and
+                response.getheader("Location")):
+                location = response.getheader("Location")
+                response.discard()
+                url = urlparse.urljoin(url, location)
+                continue
+
+            if response.status >= 300:
+                response.discard()
+                raise HTTPError(url, response.status, response.reason,
+                                response.info(), None)
+
+            return response
+
+        raise HTTPError(url, response.status, "Too many redirects",
+                        response.info(), None)
+
+    def _request(self, url, headers):
+        """Sends a single request using a pooled connection"""
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+
+        path = parts.path or "/"
+
+        if parts.query:
+            path += "?" + parts.query
+
+        headers = dict(headers)
+        headers["Connection"] = "keep-alive"
+
+        self._get_slot(key).acquire()
+
+        try:
+            conn = self._get_connection(key)
+            reused = conn.sock is not None
+
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+
+                # A reused connection may have been closed by the server
+                # while it was idle; try once more on a new connection
+                if not reused:
+                    raise
+
+                conn = self._new_connection(key)
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+        except (httplib.HTTPException, socket.error), e:
+            self._get_slot(key).release()
+            raise URLError(e)
+
+        return PooledResponse(self, key, conn, response, url)
+
+    def _get_slot(self, key):
+        """Returns the semaphore limiting the number of connections to a host"""
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.maxsize)
+            return self._slots[key]
+
+    def _get_connection(self, key):
+        """Returns an idle connection to a host if a healthy one is available,
+        or a new connection otherwise"""
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+
+                if not idle:
+                    break
+
+                conn = idle.pop()
+
+            if self._is_alive(conn):
+                return conn
+
+            conn.close()
+
+        return self._new_connection(key)
+
+    def _new_connection(self, key):
+        """Creates a new connection to a host"""
+        scheme, netloc = key
+
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _is_alive(self, conn):
+        """Checks whether an idle connection is still usable. An idle socket
+        which is readable has either been closed by the server or contains
+        unexpected data, so it should not be reused."""
+        if conn.sock is None:
+            return True
+
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error):
+            return False
+
+        return len(readable) == 0
+
+    def _release(self, key, conn, reusable):
+        """Returns a connection to the pool once its response is finished"""
+        if reusable:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+
+        self._get_slot(key).release()
+
+class PooledResponse:
+    """File-like wrapper around an HTTP response from a pooled connection"""
+    def __init__(self, pool, key, conn, response, url):
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._released = False
+
+    def read(self, amt=None):
+        """Reads from the response body"""
+        return self._response.read(amt)
+
+    def getheader(self, name, default=None):
+        """Returns the value of a response header"""
+        return self._response.getheader(name, default)
+
+    def info(self):
+        """Returns the response headers"""
+        return self._response.msg
+
+    def discard(self):
+        """Closes the response without using its body. The body is read so
+        that the connection can be reused if its length is known (including
+        responses which never have a body, such as 204 and 304)."""
+        if not self._response.will_close:
+            self.read()
+
+        self.close()
+
+    def close(self):
+        """Closes the response and releases its connection. The connection is
+        kept open for reuse only if the response was read in full and the
+        server allows keep-alive."""
+        if self._released:
+            return
+
+        self._released = True
+
+        reusable = self._response.isclosed() and not self._response.will_close
+
+        self._response.close()
+        self._pool._release(self._key, self._conn, reusable)
@@ -9,14 +9,29 @@ import time
 import logging
 import os
 import shutil
-import sunpy
+import multiprocessing
 import Queue
+import heapq
+import threading
+import urlparse
 import MySQLdb
 from random import shuffle
-from helioviewer.jp2 import process_jp2_images, BadImage
-from helioviewer.db  import get_db_cursor, mark_as_corrupt
+from multiprocessing.pool import ThreadPool
+from helioviewer.jp2 import process_jp2_images, read_headers, \
+                            read_image_params, BadImage
+from helioviewer.db  import ConnectionManager, mark_as_corrupt, \
+                          get_new_filenames, get_known_filenames, \
+                          DatasourceCache
+from helioviewer.hvpull import metrics
 from helioviewer.hvpull.browser.basebrowser import NetworkError
-from sunpy.time import is_time
+from helioviewer.hvpull.browser.cache import ListingCache
+from helioviewer.hvpull.net.pipeline import IngestWorker
+from helioviewer.hvpull.net.connection import ConnectionPool
+from helioviewer.hvpull.net.concurrency import AdaptiveLimiter
+from helioviewer.hvpull.net import workqueue
+from helioviewer.hvpull.net.retry import RetryScheduler
+from helioviewer.hvpull.net.transcode import TranscodePool, \
+                                            get_transcode_options
 
 class ImageRetrievalDaemon:
     """Retrieves images from the server as specified"""
@@ -28,14 +43,34 @@ class ImageRetrievalDaemon:
         self.dbpass = conf.get('database', 'pass')
 
         self.downloaders = []
+        self.ingest_worker = None
+        self.transcode_pool = None
+        self.header_pool = None
+        self.metrics_server = None
+        self.metrics_writer = None
+        self.work_queue = None
+        self.retry_scheduler = None
+
+        # Each thread gets its own connection. Statements are retried until
+        # the database is available again if the connection is lost.
+        self.db = ConnectionManager(self.dbname, self.dbuser, self.dbpass,
+                                    retries=None)
 
         try:
-            self._db = get_db_cursor(self.dbname, self.dbuser, self.dbpass)
+            self.db.connect()
         except MySQLdb.OperationalError:
             logging.error("Unable to access MySQL. Is the database daemon running?")
             self.shutdown()
             self.stop()
 
+        # Filenames already present in the images or corrupt tables
+        logging.info("Loading list of known images")
+        self.known_files = get_known_filenames(self.db.cursor())
+        logging.info("Found %d known images", len(self.known_files))
+
+        # Datasources are loaded once and reused for each batch
+        self.datasources = DatasourceCache()
+
         # Email notification
         self.email_server = conf.get('notifications', 'server')
         self.email_from = conf.get('notifications', 'from')
@@ -47,6 +82,48 @@ class ImageRetrievalDaemon:
         # Maximum number of simultaneous downloads
         self.max_downloads = conf.getint('network', 'max_downloads')
 
+        # Adaptive mode: the number of active downloads for each server varies
+        # between min_downloads and max_downloads depending on throughput
+        self.adaptive_downloads = get_option(conf, 'network',
+                                             'adaptive_downloads', False)
+        self.min_downloads = get_option(conf, 'network', 'min_downloads', 1)
+
+        # Failed transfers are retried with exponential backoff, up to
+        # max_attempts times. Files which still fail are skipped for
+        # retry_failed_after hours.
+        self.retry_scheduler = RetryScheduler(
+            get_option(conf, 'network', 'max_attempts', 5),
+            get_option(conf, 'network', 'retry_delay', 30),
+            get_option(conf, 'network', 'max_retry_delay', 3600),
+            self._on_failure)
+        self.retry_scheduler.setDaemon(True)
+        self.retry_scheduler.start()
+
+        self.retry_failed_after = get_option(conf, 'network',
+                                             'retry_failed_after', 24) * 3600
+        self.failed_files = {}
+
+        # Maximum number of directories to scan simultaneously, in total and
+        # for any single host
+        self.max_scans = get_option(conf, 'network', 'max_scans', 1)
+        self.max_scans_per_host = get_option(conf, 'network',
+                                             'max_scans_per_host', 4)
+        self._host_locks = {}
+
+        # Pipelined mode: files are ingested as soon as they are downloaded
+        self.pipeline = get_option(conf, 'processing', 'pipeline', False)
+        self.queue_size = get_option(conf, 'processing', 'queue_size', 100)
+
+        # Number of kdu_transcode processes to run in parallel
+        self.transcode_pool = TranscodePool(
+            get_option(conf, 'processing', 'transcode_processes', 1))
+
+        # Number of processes to use when parsing image headers
+        header_processes = get_option(conf, 'processing', 'header_processes', 1)
+
+        if header_processes > 1:
+            self.header_pool = multiprocessing.Pool(header_processes)
+
         # Directories
         self.working_dir = os.path.expanduser(conf.get('directories',
                                                        'working_dir'))
@@ -58,6 +135,25 @@ class ImageRetrievalDaemon:
         # Check directory permission
         self._init_directories()
 
+        # Keep-alive connections shared by the browsers and downloaders
+        self.connection_pool = ConnectionPool(
+            get_option(conf, 'network', 'max_connections_per_host', 8))
+
+        # Cache of remote directory listings
+        self.listing_cache = None
+
+        if get_option(conf, 'network', 'listing_cache', False):
+            self.listing_cache = ListingCache(
+                os.path.join(self.working_dir, 'listings.db'),
+                get_option(conf, 'network', 'closed_directory_age', 0))
+
+        # Durable record of files which are being acquired
+        if get_option(conf, 'processing', 'work_queue', False):
+            self.work_queue = workqueue.WorkQueue(
+                os.path.join(self.working_dir, 'workqueue.db'))
+            self.failed_files = self.work_queue.get_failed(
+                time.time() - self.retry_failed_after)
+
         # Load data server, browser, and downloader
         self.servers = self._load_servers(servers)
 
@@ -65,14 +161,37 @@ class ImageRetrievalDaemon:
         self.downloaders = []
         self.queues = []
 
+        # Ingest stage for pipelined mode
+        self.ingest_queue = None
+
+        if self.pipeline:
+            self.ingest_queue = Queue.Queue(self.queue_size)
+            self.ingest_worker = IngestWorker(self.ingest_queue, self.ingest)
+            self.ingest_worker.setDaemon(True)
+            self.ingest_worker.start()
+
         # For each server instantiate a browser and one or more downloaders
         for server in self.servers:
             self.browsers.append(self._load_browser(browse_method, server))
             queue = Queue.Queue()
             self.queues.append(queue)
-            self.downloaders.append([self._load_downloader(download_method, queue)
+
+            if self.adaptive_downloads:
+                limiter = AdaptiveLimiter(server.name, self.min_downloads,
+                                          self.max_downloads)
+            else:
+                limiter = None
+
+            self.downloaders.append([self._load_downloader(download_method,
+                                                           queue, limiter)
                                      for i in range(self.max_downloads)])
 
+        # Newest observation date ingested for each datasource
+        self.newest_images = {}
+
+        # Metrics endpoint and/or text file
+        self._init_metrics(conf)
+
         # Shutdown switch
         self.shutdown_requested = False
 
@@ -85,113 +204,298 @@ class ImageRetrievalDaemon:
         # @TODO: Process urls in batches of ~1-500.. this way images start
         # appearing more quickly when filling in large gaps, etc.
 
-        # @TODO: Redo handling of server-specific start time and pause
-        # time
-        #
         # @TODO: Send email notification when HVpull stops/exits for any reason?
 
-        # Determine starttime to use
+        # Determine starttime to use. If none is specified each server's
+        # default start time is used.
         if starttime is not None:
             starttime = datetime.datetime.strptime(starttime, date_fmt)
-        else:
-            starttime = self.servers[0].get_starttime()
+
+        # Finish any work left over from the last time HVPull was run
+        self.resume()
 
         # If end time is specified, fill in data from start to end
         if endtime is not None:
             endtime = datetime.datetime.strptime(endtime, date_fmt)
             self.query(starttime, endtime)
-            self.sleep()
 
             return None
-        else:
+
         # Otherwise, first query from start -> now
-            now = datetime.datetime.utcnow()
-            self.query(starttime, now)
-            self.sleep()
+        now = datetime.datetime.utcnow()
+        self.query(starttime, now)
+
+        # Each server is polled on its own schedule: keep track of when each
+        # one is next due to be checked
+        schedule = [(now + server.pause, i)
+                    for i, server in enumerate(self.servers)]
+        heapq.heapify(schedule)
 
         # Begin main loop
         while not self.shutdown_requested:
+            self.sleep(schedule[0][0])
+
+            if self.shutdown_requested:
+                break
+
+            # Query all servers which are due using their default windows
             now = datetime.datetime.utcnow()
-            starttime = self.servers[0].get_starttime()
+            due = []
+
+            while len(schedule) > 0 and schedule[0][0] <= now:
+                due.append(heapq.heappop(schedule)[1])
 
             # get a list of files available
-            self.query(starttime, now)
+            self.query(None, now, due)
+
+            # Schedule next check
+            now = datetime.datetime.utcnow()
 
-            self.sleep()
+            for i in due:
+                heapq.heappush(schedule, (now + self.servers[i].pause, i))
 
         # Shutdown
         self.stop()
 
-    def sleep(self):
-        """Sleep for some time before checking again for new images"""
+    def sleep(self, until):
+        """Sleep until it is time to check again for new images"""
         if self.shutdown_requested:
             return
 
-        logging.info("Sleeping for %d minutes." % (self.servers[0].pause.total_seconds() / 60))
-        time.sleep(self.servers[0].pause.total_seconds())
+        seconds = (until - datetime.datetime.utcnow()).total_seconds()
+
+        if seconds <= 0:
+            return
+
+        logging.info("Sleeping for %d minutes." % (seconds / 60))
+
+        while (not self.shutdown_requested and
+               datetime.datetime.utcnow() < until):
+            time.sleep(1)
+
+    def resume(self):
+        """Resumes work which was in progress when HVPull last stopped.
+
+        Files which were already archived are added to the database, files
+        which were downloaded are ingested, and files which were discovered
+        are downloaded again (resuming any partial downloads).
+        """
+        if self.work_queue is None:
+            return
+
+        # Archived images which still need to be added to the database
+        filepaths = [filepath for server, url, filepath in
+                     self.work_queue.get(workqueue.TRANSCODED)]
+
+        if len(filepaths) > 0:
+            logging.info("Resuming: adding %d archived images to database",
+                         len(filepaths))
+            self._insert_archived(filepaths)
+
+        # Downloaded images which still need to be ingested. Any which are
+        # no longer in the incoming directory are downloaded again.
+        urls = []
+
+        for server, url, filepath in self.work_queue.get(workqueue.DOWNLOADED):
+            if filepath and os.path.isfile(filepath):
+                urls.append(url)
+            else:
+                self.work_queue.set_state([os.path.basename(url)],
+                                          workqueue.DISCOVERED)
+
+        if len(urls) > 0 and not self.shutdown_requested:
+            logging.info("Resuming: ingesting %d downloaded images", len(urls))
+            self.ingest(urls)
+
+        # Discovered images which still need to be downloaded. Files from
+        # servers which are no longer in use are left in the queue.
+        indices = dict((server.name, i) for i, server in
+                       enumerate(self.servers))
+        urls = [[] for server in self.servers]
+
+        for server, url, filepath in self.work_queue.get(workqueue.DISCOVERED):
+            if server in indices:
+                urls[indices[server]].append(url)
+
+        if sum(len(x) for x in urls) > 0 and not self.shutdown_requested:
+            logging.info("Resuming: downloading %d discovered images",
+                         sum(len(x) for x in urls))
+            self.acquire(urls)
 
     def stop(self):
         logging.info("Exiting HVPull")
+
+        if self.work_queue is not None:
+            self.work_queue.close()
+
         sys.exit()
 
-    def query(self, starttime, endtime):
+    def query(self, starttime, endtime, servers=None):
         """Query and retrieve data within the specified range.
 
         Checks for data in the specified range and retrieves any new files.
         After execution is completed, the same range is checked again to see
         if any new files have appeared since the first execution. This continues
         until no new files are found (for xxx minutes?)
+
+        If no starttime is specified, the default start time for each server
+        is used. If a list of server indices is specified, only those servers
+        are queried.
         """
-        urls = []
+        if servers is None:
+            servers = range(len(self.servers))
 
         fmt = '%Y-%m-%d %H:%M:%S'
 
-        logging.info("Querying time range %s - %s", starttime.strftime(fmt),
-                                                    endtime.strftime(fmt))
+        for i in servers:
+            logging.info("(%s) Querying time range %s - %s",
+                         self.servers[i].name,
+                         self._get_starttime(i, starttime).strftime(fmt),
+                         endtime.strftime(fmt))
 
-        for browser in self.browsers:
-            matches = self.query_server(browser, starttime, endtime)
+        # check disk space
+        if not self.sent_diskspace_warning:
+            self._check_free_space()
 
-            if len(matches) > 0:
-                urls.append(matches)
+        # Filenames listed so far; a file which is available from more than
+        # one server is acquired from the first server to list it
+        claimed = set()
 
-        # Remove duplicate files, randomizing to spread load across servers
-        if len(urls) > 1:
-            urls = self._deduplicate(urls)
+        # New files which have not yet been queued for download
+        pending = [[] for browser in self.browsers]
 
-        # Filter out files that are already in the database
-        new_urls = []
+        found = 0
+        counter = 0.
 
-        for url_list in urls:
-            filtered = None
+        # Start acquiring the new files in each directory listing as soon as
+        # it arrives rather than waiting for every listing to complete
+        for i, matches in self.scan(starttime, endtime, servers):
+            if self.shutdown_requested:
+                break
 
-            while filtered is None:
-                try:
-                    filtered = filter(self._filter_new, url_list)
-                except MySQLdb.OperationalError:
-                    # MySQL has gone away -- try again in 5s
-                    logging.warning(("Unable to access database to check for file"
-                                   " existence. Will try again in 5 seconds."))
-                    time.sleep(5)
+            urls = []
 
-                    # Try and reconnect
+            for url in self._filter_window(i, matches,
+                                           self._get_starttime(i, starttime),
+                                           endtime):
+                filename = os.path.basename(url)
 
-                    # @note: May be a good idea to move the reconnect
-                    # functionality to the db module and have it occur
-                    # for all queries.
-                    try:
-                        self._db = get_db_cursor(self.dbname, self.dbuser, self.dbpass)
-                    except:
-                        pass
+                if filename not in claimed:
+                    claimed.add(filename)
+                    urls.append(url)
 
-            new_urls.append(filtered)
+            # Filter out files that are already in the database
+            urls = self._filter_new(urls)
 
-        # check disk space
-        if not self.sent_diskspace_warning:
-            self._check_free_space()
+            if len(urls) == 0:
+                continue
+
+            logging.info("(%s) Found %d new files", self.servers[i].name,
+                         len(urls))
+
+            found += len(urls)
+
+            # Record the files to acquire so that work can be resumed later
+            if self.work_queue is not None:
+                self.work_queue.add(self.servers[i].name, urls)
+
+            pending[i].extend(urls)
+
+            if self.pipeline:
+                counter = self._feed(pending, counter, found)
+            else:
+                self._acquire_batches(pending, len(urls))
+
+        if found == 0:
+            logging.info("Found no new files.")
+            return
 
-        # acquire the data files
-        self.acquire(new_urls)
+        # Wait for the remaining files to be downloaded and ingested
+        if self.pipeline:
+            self._acquire_pipelined(pending, found - counter, counter)
+
+        # Ingested files are now tracked by the database, and files which
+        # failed long ago will be acquired again if they are still available
+        if self.work_queue is not None and not self.shutdown_requested:
+            self.work_queue.purge(time.time() - self.retry_failed_after)
+
+    def scan(self, starttime, endtime, servers):
+        """Lists the remote directories for the specified servers which may
+        contain files in the specified range.
+
+        Yields a (server index, files) tuple for each directory as soon as its
+        listing is available. If max_scans is greater than one, directories
+        are listed in parallel, with at most max_scans_per_host concurrent
+        requests to any single host.
+        """
+        if self.max_scans <= 1:
+            for i in servers:
+                yield i, self.query_server(self.browsers[i],
+                                           self._get_starttime(i, starttime),
+                                           endtime)
+            return
+
+        jobs = []
+
+        for i in servers:
+            directories = self.browsers[i].get_directories(
+                self._get_starttime(i, starttime), endtime)
+
+            for directory in directories:
+                jobs.append((i, directory))
+
+        pool = ThreadPool(self.max_scans)
+
+        try:
+            for result in pool.imap_unordered(self._scan_directory, jobs):
+                yield result
+        finally:
+            pool.terminate()
+
+    def _get_starttime(self, i, starttime=None):
+        """Returns the start time to use when querying a server"""
+        if starttime is not None:
+            return starttime
+
+        return self.servers[i].get_starttime()
+
+    def _filter_window(self, i, urls, starttime, endtime):
+        """Removes files observed outside of the specified time range.
+
+        Remote directories are organized by day, so listings may include
+        files from before the start of the range. Observation times are
+        taken from the filenames. Files whose names are not in the standard
+        format are kept.
+        """
+        matches = []
+
+        for url in urls:
+            params = self.servers[i].parse_filename(url)
+
+            if params is None or starttime <= params['date'] <= endtime:
+                matches.append(url)
+
+        return matches
+
+    def _scan_directory(self, job):
+        """Lists a single remote directory while holding a per-host lock"""
+        i, directory = job
+
+        if self.shutdown_requested:
+            return i, []
+
+        host = urlparse.urlparse(directory).netloc
+
+        # setdefault is atomic so each host gets exactly one semaphore
+        lock = self._host_locks.setdefault(host,
+            threading.BoundedSemaphore(self.max_scans_per_host))
+
+        lock.acquire()
+
+        try:
+            return i, self._get_files(self.browsers[i], directory) or []
+        finally:
+            lock.release()
 
     def query_server(self, browser, starttime, endtime):
         """Queries a single server for new files"""
@@ -203,56 +507,87 @@ class ImageRetrievalDaemon:
 
         # Check each remote directory for new files
         for directory in directories:
-            if self.shutdown_requested:
+            matches = self._get_files(browser, directory)
+
+            if matches is None:
                 return []
 
-            matches = None
-            num_retries = 0
+            files.extend(matches)
 
-            logging.info('(%s) Scanning %s' % (browser.server.name, directory))
+        return files
 
-            # Attempt to read directory contents. Retry up to 10 times
-            # if failed and then notify admin
-            while matches is None:
-                if self.shutdown_requested:
-                    return []
+    def _get_files(self, browser, directory):
+        """Lists the JP2 files in a single remote directory, retrying if the
+        server cannot be reached. Returns None if a shutdown is requested."""
+        if self.shutdown_requested:
+            return None
 
-                try:
-                    matches = browser.get_files(directory, "jp2")
-
-                    files.extend(matches)
-                except NetworkError:
-                    if num_retries >= 3 * 1440:
-                        logging.error("Unable to reach %s. Shutting down HVPull.",
-                                      browser.server.name)
-                        msg = "Unable to reach %s. Is the server online?"
-                        self.send_email_alert(msg % browser.server.name)
-                        self.shutdown()
-                    else:
-                        msg = "Unable to reach %s. Will try again in 60 seconds."
-                        if num_retries > 0:
-                            msg += " (retry %d)" % num_retries
-                        logging.warning(msg, browser.server.name)
-                        time.sleep(60)
-                        num_retries += 1
+        matches = None
+        num_retries = 0
 
-        return files
+        logging.info('(%s) Scanning %s' % (browser.server.name, directory))
+
+        # Attempt to read directory contents. Retry up to 10 times
+        # if failed and then notify admin
+        while matches is None:
+            if self.shutdown_requested:
+                return None
+
+            t1 = time.time()
+
+            try:
+                matches = browser.get_files(directory, "jp2")
+            except NetworkError:
+                metrics.LISTINGS.inc(server=browser.server.name,
+                                     status="error")
+
+                if num_retries >= 3 * 1440:
+                    logging.error("Unable to reach %s. Shutting down HVPull.",
+                                  browser.server.name)
+                    msg = "Unable to reach %s. Is the server online?"
+                    self.send_email_alert(msg % browser.server.name)
+                    self.shutdown()
+                else:
+                    msg = "Unable to reach %s. Will try again in 60 seconds."
+                    if num_retries > 0:
+                        msg += " (retry %d)" % num_retries
+                    logging.warning(msg, browser.server.name)
+                    time.sleep(60)
+                    num_retries += 1
+            else:
+                metrics.LISTING_SECONDS.observe(time.time() - t1,
+                                                server=browser.server.name)
+                metrics.LISTINGS.inc(server=browser.server.name, status="ok")
+
+        return matches
 
     def acquire(self, urls):
         """Acquires all the available files."""
+        n = sum(len(x) for x in urls)
+
         # If no new files are available do nothing
-        if not urls:
+        if n == 0:
             logging.info("Found no new files.")
             return
 
-        n = sum(len(x) for x in urls)
+        logging.info("Found %d new files", n)
+
+        if self.pipeline:
+            self._acquire_pipelined(urls, n)
+        else:
+            self._acquire_batches(urls, n)
+
+        # Ingested files are now tracked by the database, and files which
+        # failed long ago will be acquired again if they are still available
+        if self.work_queue is not None and not self.shutdown_requested:
+            self.work_queue.purge(time.time() - self.retry_failed_after)
 
-        # Keep track of progress
+    def _acquire_batches(self, urls, n):
+        """Acquires all the available files, downloading and then ingesting
+        up to 100 files from each server at a time."""
         total = n
         counter = 0
 
-        logging.info("Found %d new files", n)
-
         # Download files
         while n > 0:
             finished = []
@@ -272,14 +607,81 @@ class ImageRetrievalDaemon:
 
                         n -= 1
 
-            for q in self.queues:
-                q.join()
+            self._wait_for(self.queues)
 
             self.ingest(finished)
 
             if self.shutdown_requested:
                 break
 
+    def _acquire_pipelined(self, urls, n, counter=0.):
+        """Acquires all the available files, passing each file to the ingest
+        stage as soon as it has been downloaded.
+
+        At most queue_size files are waiting to be downloaded from each server
+        at any time; the ingest queue is bounded by the same size so that
+        downloaders wait when ingestion falls behind. counter is the number
+        of files which have already been queued for download.
+        """
+        total = counter + n
+
+        # Feed download queues, spreading work across servers
+        while n > 0 and not self.shutdown_requested:
+            queued = self._feed(urls, counter, total)
+
+            if queued == counter:
+                time.sleep(0.1)
+
+            counter = queued
+            n = sum(len(x) for x in urls)
+
+        # Wait for in-flight downloads and ingestion to complete
+        self._wait_for(self.queues + [self.ingest_queue])
+
+    def _feed(self, urls, counter, total):
+        """Moves files onto the download queues without blocking, keeping at
+        most queue_size files waiting on each server.
+
+        Returns the number of files which have been queued, including the
+        counter files queued previously.
+        """
+        for i, server in enumerate(urls):
+            while len(server) > 0 and self.queues[i].qsize() < self.queue_size:
+                counter += 1.
+
+                self.queues[i].put([self.servers[i].name,
+                                    (counter / total) * 100, server.pop()])
+
+        return counter
+
+    def _wait_for(self, queues):
+        """Waits until all tasks in the specified queues have been processed,
+        including any which are waiting to be retried, or a shutdown is
+        requested."""
+        while not self.shutdown_requested:
+            if (sum(q.unfinished_tasks for q in queues) == 0 and
+                self.retry_scheduler.pending() == 0):
+                return
+            time.sleep(1)
+
+    def _on_download(self, server, url, filepath):
+        """Records a downloaded file and, in pipelined mode, passes it on to
+        the ingest stage"""
+        if self.work_queue is not None:
+            self.work_queue.set_state([os.path.basename(url)],
+                                      workqueue.DOWNLOADED, filepath)
+
+        if self.pipeline:
+            self.ingest_queue.put(filepath)
+
+    def _on_failure(self, url, reason):
+        """Records a file which could not be downloaded so that it is skipped
+        for a while"""
+        filename = os.path.basename(url)
+
+        self.failed_files[filename] = time.time()
+        self._set_state([filename], workqueue.FAILED, note=reason)
+
     def ingest(self, urls):
         """
         Add images to helioviewer images db.
@@ -300,40 +702,58 @@ class ImageRetrievalDaemon:
             if os.path.isfile(path):
                 filepaths.append(path)
 
+        valid = []
+
+        # Parse headers and validate metadata
+        t1 = time.time()
+        headers = read_headers(filepaths, True, self.header_pool)
+        metrics.observe_batch("header", time.time() - t1, len(filepaths))
+
         # Add to hvpull/Helioviewer.org databases
-        for filepath in filepaths:
+        for filepath, image_params in zip(filepaths, headers):
             filename = os.path.basename(filepath)
 
-            # Parse header and validate metadata
-            try:
-                try:
-                    image_params = sunpy.read_header(filepath)
-                except:
-                    raise BadImage("HEADER")
-                    logging.warn('BadImage("HEADER") error raised')
-                self._validate(image_params)
-            except BadImage, e:
+            if isinstance(image_params, BadImage):
                 logging.warn("Quarantining invalid image: %s", filename)
-                logging.warn("BadImage found; error message= %s", e.get_message())
+                logging.warn("BadImage found; error message= %s",
+                             image_params.get_message())
                 shutil.move(filepath, os.path.join(self.quarantine, filename))
-                mark_as_corrupt(self._db, filename, e.get_message())
+                mark_as_corrupt(self.db.cursor(), filename,
+                                image_params.get_message())
+                self._set_state([filename], workqueue.FAILED,
+                                note=image_params.get_message())
+                self.known_files.add(filename)
                 corrupt.append(filename)
+                metrics.INGESTED_FILES.inc(stage="header", status="error")
                 continue
 
-            # If everything looks good, move to archive and add to database
-            print image_params['date']
-            date_str = image_params['date'].strftime('%Y/%m/%d')
+            valid.append((filepath, image_params))
+            metrics.INGESTED_FILES.inc(stage="header", status="ok")
 
-            # Transcode
-            try:
-                if image_params['instrument'] == "AIA":
-                    self._transcode(filepath, cprecincts=[128, 128])
-                else:
-                    self._transcode(filepath)
-            except KduTranscodeError, e:
-                logging.warning("kdu_transcode: " + e.get_message())
+        # Transcode
+        jobs = [(filepath, get_transcode_options(image_params))
+                for filepath, image_params in valid]
+
+        t1 = time.time()
+        errors = self.transcode_pool.transcode(jobs)
+
+        metrics.observe_batch("transcode", time.time() - t1, len(jobs))
+
+        for (filepath, image_params), error in zip(valid, errors):
+            filename = os.path.basename(filepath)
+
+            if error is not None:
+                logging.warning("kdu_transcode: " + error)
+                self.failed_files[filename] = time.time()
+                self._set_state([filename], workqueue.FAILED, note=error)
+                metrics.INGESTED_FILES.inc(stage="transcode", status="error")
                 continue
 
+            metrics.INGESTED_FILES.inc(stage="transcode", status="ok")
+
+            # If everything looks good, move to archive and add to database
+            date_str = image_params['date'].strftime('%Y/%m/%d')
+
             # Move to archive
             directory = os.path.join(self.image_archive,
                                      image_params['nickname'], date_str,
@@ -351,25 +771,86 @@ class ImageRetrievalDaemon:
                                   "have the proper permissions and try again.")
                     self.shutdown_requested = True
 
+            t1 = time.time()
+
             try:
                 shutil.move(filepath, dest)
             except IOError:
                 logging.error("Unable to move files to destination. Is there "
                               "enough free space?")
+                metrics.INGESTED_FILES.inc(stage="move", status="error")
                 self.shutdown_requested = True
-
+            else:
+                metrics.INGEST_SECONDS.observe(time.time() - t1, stage="move")
+                metrics.INGESTED_FILES.inc(stage="move", status="ok")
+                self._set_state([filename], workqueue.TRANSCODED, dest)
 
             # Add to list to send to main database
             images.append(image_params)
 
         # Add valid images to main Database
-        process_jp2_images(images, self.image_archive, self._db)
+        self._insert_images(images)
 
         logging.info("Added %d images to database", len(images))
 
         if (len(corrupt) > 0):
             logging.info("Marked %d images as corrupt", len(corrupt))
 
+    def _insert_archived(self, filepaths):
+        """Adds images which have already been transcoded and moved to the
+        archive to the database. These images have already been validated so
+        their parameters are taken from their filenames where possible."""
+        images = []
+
+        for filepath, image_params in zip(filepaths, read_image_params(
+                filepaths, self.header_pool)):
+            if isinstance(image_params, BadImage):
+                logging.warn("Unable to read archived image %s: %s", filepath,
+                             image_params.get_message())
+                self._set_state([os.path.basename(filepath)],
+                                workqueue.FAILED,
+                                note=image_params.get_message())
+                continue
+
+            image_params['filepath'] = filepath
+            images.append(image_params)
+
+        self._insert_images(images)
+
+        logging.info("Added %d images to database", len(images))
+
+    def _insert_images(self, images):
+        """Adds archived images to the database"""
+        t1 = time.time()
+        process_jp2_images(images, self.image_archive, self.db.cursor(),
+                           sources=self.datasources)
+
+        metrics.observe_batch("db_insert", time.time() - t1, len(images))
+
+        if len(images) > 0:
+            metrics.INGESTED_FILES.inc(len(images), stage="db_insert",
+                                       status="ok")
+
+        filenames = [os.path.basename(img['filepath']) for img in images]
+
+        self.known_files.update(filenames)
+        self._set_state(filenames, workqueue.INGESTED)
+
+        # Keep track of the most recent data for each datasource
+        for img in images:
+            datasource = " ".join([img['observatory'], img['instrument'],
+                                   img['detector'], str(img['measurement'])])
+
+            newest = self.newest_images.get(datasource)
+
+            if newest is None or img['date'] > newest:
+                self.newest_images[datasource] = img['date']
+
+    def _set_state(self, filenames, state, filepath=None, note=None):
+        """Updates the state of files in the work queue, if one is in use"""
+        if self.work_queue is not None and len(filenames) > 0:
+            self.work_queue.set_state(filenames, state, filepath, note)
+
     def send_email_alert(self, message):
         """Sends an email notification to the Helioviewer admin(s) when a
         one of the data sources becomes unreachable."""
@@ -407,45 +888,27 @@ class ImageRetrievalDaemon:
             for downloader in server:
                 downloader.stop()
 
-    def _transcode(self, filepath, corder='RPCL', orggen_plt='yes', cprecincts=None):
-        """Transcodes JPEG 2000 images to allow support for use with JHelioviewer
-        and the JPIP server"""
-        tmp = filepath + '.tmp.jp2'
-
-        # Base command
+        if self.ingest_worker is not None:
+            self.ingest_worker.stop()
 
-        command ='kdu_transcode -i %s -o %s' % (filepath, tmp)
+        if self.retry_scheduler is not None:
+            self.retry_scheduler.stop()
 
-        # Corder
-        if corder is not None:
-            command += " Corder=%s" % corder
+        if self.transcode_pool is not None:
+            self.transcode_pool.close()
 
-        # ORGgen_plt
-        if orggen_plt is not None:
-            command += " ORGgen_plt=%s" % orggen_plt
+        # Headers of any files still being ingested are read in-process
+        if self.header_pool is not None:
+            pool = self.header_pool
+            self.header_pool = None
+            pool.close()
 
-        # Cprecincts
-        if cprecincts is not None:
-            command += " Cprecincts=\{%d,%d\}" % (cprecincts[0], cprecincts[1])
-
-        # Hide output
-        command += " >/dev/null"
-
-        # Execute kdu_transcode (retry up to five times)
-        num_retries = 0
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
-        while not os.path.isfile(tmp) and num_retries <= 5:
-            os.system(command)
-            num_retries += 1
-
-        # If transcode failed, raise an exception
-        if not os.path.isfile(tmp):
-            raise KduTranscodeError(filepath)
-
-        # Remove old version and replace with transcoded one
-        # OSError
-        os.remove(filepath)
-        os.rename(tmp, filepath)
+        if self.metrics_writer is not None:
+            self.metrics_writer.stop()
+            self.metrics_writer.write()
 
     def _check_free_space(self):
         """Checks the amount of free space on the data volume and emails admins
@@ -467,81 +930,45 @@ class ImageRetrievalDaemon:
 
         Sorting is preserved and load is distributed evenly across each server.
         """
-        # Filenames
-        files = [[os.path.basename(url) for url in x] for x in urls]
-
-        # Number of servers and total number of remote files matched
-        m = len(self.servers)
-        n = sum(len(x) for x in files)
-
-        # Counters to keep track of sub-list iteration
-        counters = [0] * m
-
-        # Loop through files, switching between servers on each iteration
-        for i in range(n):
-            idx = i % m # Server index
-
-            if(len(files[idx]) > counters[idx]):
-                value = files[idx][counters[idx]]
-
-                # Skip over files that have been set to None
-                while value is None:
-                    counters[idx] += 1
-
-                    if(len(files[idx]) > counters[idx]):
-                        value = files[idx][counters[idx]]
-                    else:
-                        break
-
-                if value is None:
-                    continue
-
-                filename = os.path.basename(value)
-
-                # Ignore file on other servers if it exists
-                for i, file_list in enumerate(files):
-                    if i == idx:
-                        continue
-
-                    if filename in file_list:
-                        j = files[i].index(filename)
-                        files[i][j] = None
-                        urls[i][j] = None
-
-            counters[idx] += 1
-
-        # Remove all entries set to None
-        new_list = []
-
-        for url_list in urls:
-            new_list.append([x for x in url_list if x is not None])
-
-        return new_list
-
-    def _validate(self, params):
-        """Filters out images that are known to have problems using information
-        in their metadata"""
-
-        # Make sure the time can be understood
-        if not is_time(params['date']):
-            raise BadImage("DATE")
-
-        # AIA
-        if params['detector'] == "AIA":
-            if params['header'].get("IMG_TYPE") == "DARK":
-                raise BadImage("DARK")
-            if float(params['header'].get('PERCENTD')) < 50:
-                raise BadImage("PERCENTD")
-            if str(params['header'].get('WAVE_STR')).endswith("_OPEN"):
-                raise BadImage("WAVE_STR")
-
-        # LASCO
-        if params['instrument'] == "LASCO":
-            hcomp_sf = params['header'].get('hcomp_sf')
-
-            if ((params['detector'] == "C2" and hcomp_sf == 32) or
-                (params['detector'] == "C3" and hcomp_sf == 64)):
-                    raise BadImage("WrongMask")
+        return deduplicate(urls)
+
+    def _init_metrics(self, conf):
+        """Starts the metrics HTTP endpoint and/or text file writer if either
+        is enabled"""
+        metrics.REGISTRY.add_collector(self._collect_metrics)
+
+        port = get_option(conf, 'metrics', 'port', 0)
+        address = get_option(conf, 'metrics', 'address', '127.0.0.1')
+        textfile = get_option(conf, 'metrics', 'textfile', '')
+
+        if port > 0:
+            self.metrics_server = metrics.MetricsServer(metrics.REGISTRY,
+                                                        port, address)
+            self.metrics_server.setDaemon(True)
+            self.metrics_server.start()
+            logging.info("Serving metrics at http://%s:%d/metrics",
+                         address, port)
+
+        if textfile:
+            self.metrics_writer = metrics.MetricsWriter(
+                metrics.REGISTRY, os.path.expanduser(textfile),
+                get_option(conf, 'metrics', 'interval', 15))
+            self.metrics_writer.setDaemon(True)
+            self.metrics_writer.start()
+
+    def _collect_metrics(self):
+        """Updates the queue depth and data lag gauges"""
+        for server, queue in zip(self.servers, self.queues):
+            metrics.QUEUE_DEPTH.set(queue.qsize(), queue=server.name)
+
+        if self.ingest_queue is not None:
+            metrics.QUEUE_DEPTH.set(self.ingest_queue.qsize(), queue="ingest")
+
+        now = datetime.datetime.utcnow()
+
+        for datasource, date in self.newest_images.items():
+            metrics.DATA_LAG.set((now - date).total_seconds(),
+                                 datasource=datasource)
 
     def _init_directories(self):
         """Checks to see if working directories exists and attempts to create
@@ -569,13 +996,19 @@ class ImageRetrievalDaemon:
         """Loads a data browser"""
         cls = self._load_class('helioviewer.hvpull.browser', browse_method,
                                self.get_browsers().get(browse_method))
-        return cls(uri)
+        return cls(uri, self.listing_cache, self.connection_pool)
 
-    def _load_downloader(self, download_method, queue):
+    def _load_downloader(self, download_method, queue, limiter=None):
         """Loads a data downloader"""
         cls = self._load_class('helioviewer.hvpull.downloader', download_method,
                                self.get_downloaders().get(download_method))
-        downloader = cls(self.incoming, queue)
+        if self.pipeline or self.work_queue is not None:
+            callback = self._on_download
+        else:
+            callback = None
+
+        downloader = cls(self.incoming, queue, callback, self.connection_pool,
+                         limiter, self.retry_scheduler)
 
         downloader.setDaemon(True)
         downloader.start()
@@ -592,25 +1025,37 @@ class ImageRetrievalDaemon:
         # Instantiate class and return
         return getattr(sys.modules[modname], classname)
 
-    def _filter_new(self, url):
+    def _filter_new(self, urls):
         """For a given list of remote files determines which ones have not
-        yet been acquired."""
-        filename = os.path.basename(url)
+        yet been acquired.
+
+        Filenames are first checked against the in-memory set of known files;
+        any remaining candidates are then verified against the database in
+        case they were added by another process (e.g. update.py).
+        """
+        candidates = [url for url in urls
+                      if os.path.basename(url) not in self.known_files]
+
+        # Skip files which failed recently
+        if len(self.failed_files) > 0:
+            cutoff = time.time() - self.retry_failed_after
+
+            for filename, failed in self.failed_files.items():
+                if failed < cutoff:
+                    del self.failed_files[filename]
 
-        # Check to see if image is in images
-        self._db.execute("SELECT COUNT(*) FROM images WHERE filename='%s'" %
-                         filename)
-        if self._db.fetchone()[0] != 0:
-            return False
+            candidates = [url for url in candidates
+                          if os.path.basename(url) not in self.failed_files]
 
-        # Check to see if image is in corrupt
-        #print('Remove comments characters to reactivate the code beneath when in production!!!')
-        self._db.execute("SELECT COUNT(*) FROM corrupt WHERE filename='%s'" %
-                 filename)
-        if self._db.fetchone()[0] != 0:
-            return False
+        if len(candidates) == 0:
+            return []
 
-        return True
+        filenames = [os.path.basename(url) for url in candidates]
+        new_files = get_new_filenames(self.db.cursor(), filenames)
+
+        self.known_files.update(set(filenames).difference(new_files))
+
+        return [url for url in candidates if os.path.basename(url) in new_files]
 
     @classmethod
     def get_servers(cls):
@@ -640,10 +1085,56 @@ class ImageRetrievalDaemon:
             "localmove": "LocalFileMove"
         }
 
-class KduTranscodeError(RuntimeError):
-    """Exception to raise an image cannot be transcoded."""
-    def __init__(self, message=""):
-        self.message = message
-    def get_message(self):
-        return self.message
-
+def deduplicate(urls):
+    """Removes files which are available from more than one server
+
+    Servers take turns claiming their next unclaimed file so that load is
+    distributed evenly across each server. Sorting within each list is
+    preserved. Runs in time linear in the total number of urls.
+    """
+    files = [[os.path.basename(url) for url in x] for x in urls]
+
+    # Server index which each filename will be downloaded from
+    owners = {}
+
+    # Counters to keep track of sub-list iteration
+    counters = [0] * len(files)
+    remaining = sum(len(x) for x in files)
+
+    # Loop through files, switching between servers on each iteration
+    while remaining > 0:
+        for idx, file_list in enumerate(files):
+            # Skip over files that have been claimed by another server
+            while (counters[idx] < len(file_list) and
+                   owners.get(file_list[counters[idx]], idx) != idx):
+                counters[idx] += 1
+                remaining -= 1
+
+            if counters[idx] < len(file_list):
+                owners[file_list[counters[idx]]] = idx
+                counters[idx] += 1
+                remaining -= 1
+
+    # Keep only the copy of each file on the server which claimed it
+    new_list = []
+
+    for idx, url_list in enumerate(urls):
+        new_list.append([url for url, filename in zip(url_list, files[idx])
+                         if owners[filename] == idx])
+
+    return new_list
+
+def get_option(conf, section, option, default):
+    """Returns an optional configuration value, using the type of the default
+    value to parse it. The default is returned if the option is not set."""
+    if not conf.has_option(section, option):
+        return default
+
+    if isinstance(default, bool):
+        return conf.getboolean(section, option)
+    elif isinstance(default, int):
+        return conf.getint(section, option)
+    elif isinstance(default, float):
+        return conf.getfloat(section, option)
+    else:
+        return conf.get(section, option)
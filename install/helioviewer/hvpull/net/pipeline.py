@@ -0,0 +1,58 @@
+"""Streaming ingest stage for HVPull
+
+When HVPull is run in pipelined mode each downloader passes a finished file
+straight to an IngestWorker through a bounded queue, so that downloading and
+ingestion (header parsing, transcoding, archiving and database insertion)
+can proceed at the same time.
+"""
+import logging
+import threading
+import Queue
+
+class IngestWorker(threading.Thread):
+    """Pulls downloaded files from a queue and ingests them in small batches"""
+    def __init__(self, queue, ingest, batch_size=25):
+        """Creates a new IngestWorker
+
+        Parameters
+        ----------
+        queue : Queue.Queue
+            queue of local filepaths which are ready to be ingested
+        ingest : function
+            function to call with a list of filepaths to ingest
+        batch_size : int
+            maximum number of files to pass to ingest at once
+        """
+        threading.Thread.__init__(self)
+
+        self.shutdown_requested = False
+        self.queue = queue
+        self.ingest = ingest
+        self.batch_size = batch_size
+
+    def stop(self):
+        self.shutdown_requested = True
+
+    def run(self):
+        """Ingests files as they become available"""
+        while not self.shutdown_requested:
+            # Wait for the next file, checking for shutdown requests
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except Queue.Empty:
+                continue
+
+            # Grab any other files that are already waiting
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            try:
+                self.ingest(batch)
+            except Exception, e:
+                logging.error("Failed to ingest %d files: %s", len(batch), e)
+
+            for i in range(len(batch)): #pylint: disable=W0612
+                self.queue.task_done()
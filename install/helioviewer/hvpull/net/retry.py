@@ -0,0 +1,122 @@
+"""Delayed retries for failed transfers
+
+Rather than putting a failed download straight back onto its queue, the
+downloaders hand it to a RetryScheduler which puts it back once a delay has
+passed. Delays grow exponentially with the number of attempts and include a
+random jitter so that files which failed together are not retried together.
+"""
+import time
+import heapq
+import random
+import logging
+import threading
+
+class RetryScheduler(threading.Thread):
+    """Puts failed items back onto their queues after a backoff delay"""
+    def __init__(self, max_attempts=5, delay=30, max_delay=3600,
+                 on_failure=None):
+        """Creates a new RetryScheduler
+
+        Parameters
+        ----------
+        max_attempts : int
+            number of attempts after which an item is given up on
+        delay : float
+            delay in seconds before the first retry
+        max_delay : float
+            maximum delay in seconds between attempts
+        on_failure : function
+            function to call with the key of an item and the reason for the
+            last failure once it has used up all of its attempts
+        """
+        threading.Thread.__init__(self)
+
+        self.shutdown_requested = False
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.on_failure = on_failure
+
+        self._cond = threading.Condition()
+        self._heap = []
+        self._attempts = {}
+        self._counter = 0
+        self._pending = 0
+
+    def stop(self):
+        self.shutdown_requested = True
+
+        with self._cond:
+            self._cond.notify()
+
+    def retry(self, queue, item, key, reason=""):
+        """Schedules an item to be put back onto a queue after a delay.
+
+        Returns False if the item has used up all of its attempts, in which
+        case it is not retried and on_failure is called.
+        """
+        with self._cond:
+            attempts = self._attempts.get(key, 0) + 1
+
+            if attempts >= self.max_attempts:
+                self._attempts.pop(key, None)
+                exhausted = True
+            else:
+                self._attempts[key] = attempts
+                exhausted = False
+
+                due = time.time() + self.get_delay(attempts)
+
+                # Counter keeps ordering stable for items due at the same time
+                self._counter += 1
+                heapq.heappush(self._heap, (due, self._counter, queue, item))
+                self._pending += 1
+                self._cond.notify()
+
+        if exhausted:
+            logging.error("Giving up on %s after %d attempts.", key, attempts)
+
+            if self.on_failure is not None:
+                self.on_failure(key, reason)
+
+            return False
+
+        return True
+
+    def succeeded(self, key):
+        """Forgets the failed attempts for an item which has succeeded"""
+        with self._cond:
+            self._attempts.pop(key, None)
+
+    def get_delay(self, attempts):
+        """Returns the delay to use before the specified retry, using
+        exponential backoff with jitter of up to +/- 50%"""
+        delay = min(self.max_delay, self.delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+    def pending(self):
+        """Returns the number of items waiting to be retried"""
+        with self._cond:
+            return self._pending
+
+    def run(self):
+        """Puts items back onto their queues as they become due"""
+        while not self.shutdown_requested:
+            with self._cond:
+                if len(self._heap) == 0:
+                    self._cond.wait(1)
+                    continue
+
+                wait = self._heap[0][0] - time.time()
+
+                if wait > 0:
+                    self._cond.wait(min(wait, 1))
+                    continue
+
+                due, counter, queue, item = heapq.heappop(self._heap) #pylint: disable=W0612
+
+            queue.put(item)
+
+            # Only counted as done once the item is back on its queue
+            with self._cond:
+                self._pending -= 1
@@ -0,0 +1,120 @@
+"""kdu_transcode helper functions
+
+Transcodes JPEG 2000 images to allow support for use with JHelioviewer and
+the JPIP server. Images can be transcoded one at a time or in parallel using
+a TranscodePool.
+"""
+import os
+import subprocess
+import multiprocessing
+
+def get_transcode_options(image_params):
+    """Returns the instrument-specific kdu_transcode parameters to use for an
+    image"""
+    if image_params['instrument'] == "AIA":
+        return {"cprecincts": [128, 128]}
+
+    return {}
+
+def transcode(filepath, corder='RPCL', orggen_plt='yes', cprecincts=None,
+              retries=5):
+    """Transcodes JPEG 2000 images to allow support for use with JHelioviewer
+    and the JPIP server"""
+    tmp = filepath + '.tmp.jp2'
+
+    # Base command
+    command = ['kdu_transcode', '-i', filepath, '-o', tmp]
+
+    # Corder
+    if corder is not None:
+        command.append("Corder=%s" % corder)
+
+    # ORGgen_plt
+    if orggen_plt is not None:
+        command.append("ORGgen_plt=%s" % orggen_plt)
+
+    # Cprecincts
+    if cprecincts is not None:
+        command.append("Cprecincts={%d,%d}" % (cprecincts[0], cprecincts[1]))
+
+    # Execute kdu_transcode (retry up to five times), hiding output
+    devnull = open(os.devnull, 'w')
+
+    try:
+        for i in range(retries + 1): #pylint: disable=W0612
+            try:
+                status = subprocess.call(command, stdout=devnull,
+                                         stderr=devnull)
+            except OSError, e:
+                raise KduTranscodeError("%s (%s)" % (filepath, e.strerror))
+
+            if status == 0 and os.path.isfile(tmp):
+                break
+
+            # Remove any partially written output before trying again
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+        else:
+            raise KduTranscodeError("%s (exit status %d)" % (filepath, status))
+    finally:
+        devnull.close()
+
+    # Remove old version and replace with transcoded one
+    os.remove(filepath)
+    os.rename(tmp, filepath)
+
+def _transcode_job(job):
+    """Transcodes a single image inside of a worker process and returns an
+    error message if it could not be transcoded"""
+    filepath, options = job
+
+    try:
+        transcode(filepath, **options)
+    except KduTranscodeError, e:
+        return e.get_message()
+    except OSError, e:
+        return "%s (%s)" % (filepath, e)
+
+    return None
+
+class TranscodePool:
+    """Transcodes batches of images using a pool of worker processes"""
+    def __init__(self, processes=1):
+        """Creates a new TranscodePool
+
+        If only a single process is requested images are transcoded in the
+        calling process.
+        """
+        self.processes = processes
+        self._pool = None
+
+        if processes > 1:
+            self._pool = multiprocessing.Pool(processes)
+
+    def transcode(self, jobs):
+        """Transcodes a list of (filepath, options) jobs
+
+        Returns a list of error messages in the same order as the jobs with
+        None for each image that was successfully transcoded.
+        """
+        if len(jobs) == 0:
+            return []
+
+        if self._pool is None:
+            return [_transcode_job(job) for job in jobs]
+
+        return self._pool.map(_transcode_job, jobs)
+
+    def close(self):
+        """Shuts down the worker processes"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+class KduTranscodeError(RuntimeError):
+    """Exception to raise an image cannot be transcoded."""
+    def __init__(self, message=""):
+        self.message = message
+    def get_message(self):
+        return self.message
@@ -0,0 +1,108 @@
+"""Durable work queue for HVPull
+
+Records the progress of each file HVPull has decided to acquire in a SQLite
+database so that work which was in flight when HVPull stopped can be resumed
+on the next start instead of being rediscovered.
+
+Each file moves through the following states:
+
+    discovered  -> found on a remote server and not yet downloaded
+    downloaded  -> saved to the incoming directory
+    transcoded  -> transcoded and moved into the image archive
+    ingested    -> added to the database
+    failed      -> could not be ingested (e.g. corrupt or transcode error)
+"""
+import os
+import time
+import sqlite3
+import threading
+
+DISCOVERED = "discovered"
+DOWNLOADED = "downloaded"
+TRANSCODED = "transcoded"
+INGESTED = "ingested"
+FAILED = "failed"
+
+class WorkQueue:
+    """SQLite-backed record of the state of each file being acquired"""
+    def __init__(self, filepath):
+        """Opens or creates a work queue at the specified location"""
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filepath, check_same_thread=False)
+        self._db.text_factory = str
+
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                filename TEXT PRIMARY KEY,
+                server   TEXT NOT NULL,
+                url      TEXT NOT NULL,
+                state    TEXT NOT NULL,
+                filepath TEXT,
+                note     TEXT,
+                updated  REAL NOT NULL
+            )""")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS files_state ON files (state)")
+        self._db.commit()
+
+    def add(self, server, urls):
+        """Records newly discovered files. Files which are already in the
+        queue (e.g. because they previously failed or were left unfinished)
+        are acquired again from the start."""
+        now = time.time()
+        rows = [(os.path.basename(url), server, url, DISCOVERED, now)
+                for url in urls]
+
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO files "
+                "(filename, server, url, state, updated) "
+                "VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def set_state(self, filenames, state, filepath=None, note=None):
+        """Updates the state of one or more files"""
+        now = time.time()
+        rows = [(state, filepath, note, now, filename)
+                for filename in filenames]
+
+        with self._lock:
+            self._db.executemany(
+                "UPDATE files SET state=?, filepath=?, note=?, updated=? "
+                "WHERE filename=?", rows)
+            self._db.commit()
+
+    def get(self, state):
+        """Returns a list of (server, url, filepath) tuples for all files in
+        the specified state"""
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT server, url, filepath FROM files WHERE state=? "
+                "ORDER BY filename", (state,))
+            return cursor.fetchall()
+
+    def get_failed(self, since=0):
+        """Returns a dictionary mapping the filename of each file which has
+        failed since the specified time to the time that it failed"""
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT filename, updated FROM files "
+                "WHERE state=? AND updated >= ?", (FAILED, since))
+            return dict(cursor.fetchall())
+
+    def purge(self, failed_before=0):
+        """Removes ingested files, which are now tracked by the database, and
+        files which failed before the specified time and are no longer being
+        skipped"""
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE state=?", (INGESTED,))
+            self._db.execute("DELETE FROM files WHERE state=? AND updated < ?",
+                             (FAILED, failed_before))
+            self._db.commit()
+
+    def close(self):
+        """Closes the work queue"""
+        with self._lock:
+            self._db.close()
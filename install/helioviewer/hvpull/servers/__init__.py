@@ -1,6 +1,7 @@
 """Classes for working with known data servers"""
 import os
 import datetime
+from helioviewer.jp2 import __FILENAME_REGEX__, parse_filename
 
 class DataServer:
     """Class for interacting with data servers."""
@@ -10,12 +11,7 @@ class DataServer:
         self.pause = datetime.timedelta(minutes=pause)
         
         # Example: 2011_11_17__08_13_08_13__SDO_AIA_AIA_304.jp2
-        self.filename_regex = (
-            "^(?P<year>\d{4})_(?P<month>\d{2})_(?P<day>\d{2})__" +
-            "(?P<hour>\d{2})_(?P<min>\d{2})_(?P<sec>\d{2})_" + 
-            "(?P<microsec>\d{2,3})__" +
-            "(?P<obs>[a-zA-Z0-9]{3})_(?P<inst>[a-zA-Z0-9]{3})_" +
-            "(?P<det>[a-zA-Z0-9]{3})_(?P<meas>[a-zA-Z0-9]{2,11})\.jp2$")
+        self.filename_regex = __FILENAME_REGEX__
         
     def compute_directories(self, start_date, end_date):
         """Creates a list of possible directories containing new files"""
@@ -46,6 +42,11 @@ class DataServer:
         the server"""
         return self.filename_regex
 
+    def parse_filename(self, filename):
+        """Returns the date and datasource of a file on the server from its
+        filename, or None if the filename is not in the expected format"""
+        return parse_filename(filename)
+
     def get_measurements(self, nicknames, dates):
         """Get a list of all the URIs down to the measurement"""
         return None
@@ -2,11 +2,15 @@
 """A text-based installer for Helioviewer.org"""
 import sys
 import os
-import gc
 import getpass
-import sunpy
+import itertools
+import multiprocessing
 from helioviewer.jp2 import *
 from helioviewer.db  import *
+from helioviewer.journal import IngestJournal
+
+# Record of completed directories, used to resume an interrupted installation
+__JOURNAL__ = "helioviewer-install.journal"
 
 class HelioviewerConsoleInstaller:
     """Text-based installer class"""
@@ -15,11 +19,20 @@ class HelioviewerConsoleInstaller:
         
         path = self.get_filepath()
         
-        # Locate jp2 images in specified filepath
-        filepaths = find_images(path)
+        # Directories which were completed by an interrupted installation
+        journal = IngestJournal(__JOURNAL__, path)
+
+        if len(journal) > 0:
+            print("Resuming installation: skipping %d directories which have "
+                  "already been processed." % len(journal))
+
+        # Locate jp2 images in specified filepath, 10,000 at a time
+        batches = find_image_batches(path, exclude=journal)
+        first = next(batches, None)
         
         # Check to make sure some images were found
-        if len(filepaths) is 0:
+        if first is None:
+            journal.finish()
             print("No JPEG 2000 images found. Exiting installation.")
             sys.exit(2)
             
@@ -28,31 +41,40 @@ class HelioviewerConsoleInstaller:
         
         print("Processing Images...")
 
-        # Extract image parameters, 10,000 at a time
-        while len(filepaths) > 0:
-            subset = filepaths[:10000]
-            filepaths = filepaths[10000:]
+        # Pool of processes to parse image headers with
+        pool = multiprocessing.Pool()
+
+        # Datasources are loaded once and reused for each batch
+        sources = DatasourceCache()
 
+        # Extract image parameters for each batch as it is found
+        for subset, directories in itertools.chain([first], batches):
             images = []
-            
-            for filepath in subset:
-                try:
-                    image = sunpy.read_header(filepath)
-                    image['filepath'] = filepath
-                    images.append(image)
-                except:
-                    #raise BadImage("HEADER")
+
+            # Skip images which are already in the database
+            subset = filter_new_images(cursor, subset)
+
+            params = read_image_params(subset, pool)
+
+            for filepath, image in zip(subset, params):
+                if isinstance(image, BadImage):
                     print("Skipping corrupt image: %s" %
                           os.path.basename(filepath))
                     continue
+
+                image['filepath'] = filepath
+                images.append(image)
             
             # Insert image information into database
             if len(images) > 0:
-                process_jp2_images(images, path, cursor, mysql)
-                
-            # clean up afterwards
-            images = []
-            gc.collect()
+                process_jp2_images(images, path, cursor, mysql, bulk=True,
+                                   sources=sources)
+
+            # Checkpoint directories whose images are all in the database
+            journal.commit(directories)
+
+        pool.close()
+        journal.finish()
 
         # close db connection
         cursor.close()
@@ -75,7 +97,8 @@ class HelioviewerConsoleInstaller:
         print("Please enter Helioviewer.org database user information")
         dbuser, dbpass, mysql = self.get_database_info()
         
-        cursor = get_db_cursor(dbname, dbuser, dbpass, mysql)
+        cursor = get_db_cursor(dbname, dbuser, dbpass, mysql,
+                               local_infile=True)
         
         return cursor, mysql
         
@@ -92,7 +115,7 @@ class HelioviewerConsoleInstaller:
         # Setup database schema
         try:
             cursor = setup_database_schema(dbuser, dbpass, dbname, hvuser, 
-                                           hvpass, mysql)
+                                           hvpass, mysql, local_infile=True)
             return cursor, mysql
         except:
             print("Specified database already exists! Exiting installer.")
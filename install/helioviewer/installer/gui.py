@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 import sys
-import gc
 import math
 import getpass
-import sunpy
+import multiprocessing
 from PyQt4 import QtCore, QtGui
 from helioviewer.installer.installwizard import Ui_InstallWizard
 from helioviewer.jp2 import *
@@ -64,10 +63,9 @@ class HelioviewerInstallWizard(QtGui.QWizard):
             
             self.ui.statusMsg.setText("Searching for JPEG 2000 Images...")
             
-            # Locate jp2 images in specified filepath
-            self.filepaths = find_images(jp2dir)
-
-            n = len(self.filepaths)
+            # Count the jp2 images in specified filepath. They are located
+            # again in batches when processing begins.
+            n = sum(1 for filepath in find_images(jp2dir))
 
             if n == 0:
                 print("No JPEG 2000 images found. Exiting installation.")
@@ -121,34 +119,37 @@ If this is correct, please press "Start" to begin processing.
 
         self.ui.statusMsg.setText("Creating database schema")
 
-        cursor = setup_database_schema(admin, adminpass, hvdb, hvuser, hvpass, mysql)
+        cursor = setup_database_schema(admin, adminpass, hvdb, hvuser, hvpass,
+                                       mysql, local_infile=True)
         
-        # Extract image parameters, 10,000 at a time
-        while len(self.filepaths) > 0:
-            subset = self.filepaths[:10000]
-            self.filepaths = self.filepaths[10000:]
+        # Pool of processes to parse image headers with
+        pool = multiprocessing.Pool()
+
+        # Datasources are loaded once and reused for each batch
+        sources = DatasourceCache()
 
+        # Extract image parameters, 10,000 at a time
+        for subset, directories in find_image_batches(jp2dir):
             images = []
-            
-            for filepath in subset:
-                try:
-                    image = sunpy.read_header(filepath)
-                    image['filepath'] = filepath
-                    images.append(image)
-                except:
-                    #raise BadImage("HEADER")
+
+            params = read_image_params(subset, pool)
+
+            for filepath, image in zip(subset, params):
+                if isinstance(image, BadImage):
                     print("Skipping corrupt image: %s" %
                           os.path.basename(filepath))
                     continue
+
+                image['filepath'] = filepath
+                images.append(image)
             
             # Insert image information into database
             if len(images) > 0:
-                process_jp2_images(images, jp2dir, cursor, mysql, self.update_progress)
-                
-            # clean up afterwards
-            images = []
-            gc.collect()
+                process_jp2_images(images, jp2dir, cursor, mysql,
+                                   self.update_progress, bulk=True,
+                                   sources=sources)
     
+        pool.close()
         cursor.close()
         #self.ui.installProgress.setValue(len(images))
     
@@ -0,0 +1,88 @@
+"""Checkpoint journal for bulk image ingestion
+
+Records the directories whose images have all been added to the database so
+that an interrupted run of the installer or update.py can be resumed without
+processing those directories again.
+
+The journal is a text file whose first line is the root directory being
+processed, followed by one line per completed directory (relative to the
+root). Lines are appended and synced to disk once each batch has been
+committed to the database.
+"""
+import os
+
+class IngestJournal:
+    """Journal of the directories which have been completely ingested"""
+    def __init__(self, filepath, root):
+        """Opens the journal at filepath for the specified root directory.
+
+        Directories recorded by a previous run are kept only if that run was
+        processing the same root directory.
+        """
+        self.filepath = filepath
+        self.root = os.path.abspath(root)
+        self._completed = set()
+
+        if os.path.isfile(filepath):
+            fp = open(filepath)
+            lines = fp.read().split("\n")
+            fp.close()
+
+            # The last segment is either empty or a partially written line
+            lines = lines[:-1]
+
+            if len(lines) > 0 and lines[0] == self.root:
+                self._completed.update(line for line in lines[1:] if line)
+
+        # Rewrite the journal atomically, discarding any partial line or
+        # directories from a different root
+        tmp = filepath + ".tmp"
+
+        self._fp = open(tmp, "w")
+        self._fp.write(self.root + "\n")
+
+        for directory in sorted(self._completed):
+            self._fp.write(directory + "\n")
+
+        self._sync()
+        self._fp.close()
+
+        os.rename(tmp, filepath)
+
+        self._fp = open(filepath, "a")
+
+    def __len__(self):
+        return len(self._completed)
+
+    def __contains__(self, directory):
+        """Returns True if a directory has been completely ingested"""
+        return self._relpath(directory) in self._completed
+
+    def commit(self, directories):
+        """Records directories whose images have been added to the database"""
+        for directory in directories:
+            directory = self._relpath(directory)
+
+            if directory not in self._completed:
+                self._completed.add(directory)
+                self._fp.write(directory + "\n")
+
+        self._sync()
+
+    def finish(self):
+        """Closes and removes the journal once all images have been
+        ingested"""
+        self._fp.close()
+        os.remove(self.filepath)
+
+    def close(self):
+        """Closes the journal, keeping it so that the run can be resumed"""
+        self._fp.close()
+
+    def _relpath(self, directory):
+        return os.path.relpath(os.path.abspath(directory), self.root)
+
+    def _sync(self):
+        """Makes sure recorded directories are on disk"""
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
@@ -1,53 +1,565 @@
 # -*- coding: utf-8 -*-
 """Helioviewer.org JPEG 2000 processing functions"""
 import os
+import re
+import mmap
+import stat
+import Queue
+import struct
 import logging
-import sunpy
-from helioviewer.db import get_datasources, enable_datasource
+import datetime
+import tempfile
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from helioviewer.db import DatasourceCache, get_new_filenames
 
 __INSERTS_PER_QUERY__ = 500
 __STEP_FXN_THROTTLE__ = 50
+__IMAGES_PER_BATCH__ = 10000
+__WALK_THREADS__ = 8
 
-def find_images(path):
+# FITS keywords stored in the XML box, e.g. <WAVELNTH>304</WAVELNTH>
+__FITS_REGEX__ = re.compile(r"<([A-Za-z_][\w\-]*)>([^<]*)</\1>")
+__FITS_SECTION_REGEX__ = re.compile(r"<fits>(.*?)</fits>", re.DOTALL)
+
+__XML_ENTITIES__ = [("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'),
+                    ("&apos;", "'"), ("&amp;", "&")]
+
+# Standard Helioviewer filenames
+# Example: 2011_11_17__08_13_08_13__SDO_AIA_AIA_304.jp2
+#          2011_11_17__08_06_07_123__SOHO_LASCO_C2_white-light.jp2
+__FILENAME_REGEX__ = re.compile(
+    r"^(?P<year>\d{4})_(?P<month>\d{2})_(?P<day>\d{2})__"
+    r"(?P<hour>\d{2})_(?P<min>\d{2})_(?P<sec>\d{2})_"
+    r"(?P<microsec>\d{2,3})__"
+    r"(?P<obs>[a-zA-Z0-9\-]+)_(?P<inst>[a-zA-Z0-9\-]+)_"
+    r"(?P<det>[a-zA-Z0-9\-]+)_(?P<meas>[a-zA-Z0-9\-]+)\.jp2$")
+
+def find_images(path, threads=__WALK_THREADS__):
     '''Searches a directory for JPEG 2000 images.
     
-    Traverses file-tree starting with the specified path and builds a list of
-    the available images.
+    Traverses file-tree starting with the specified path and yields the
+    filepath of each image as it is found. If more than one thread is used,
+    directories are listed concurrently and images are yielded in no
+    particular order.
     '''
-    images = []
-    
+    for directory, images in find_image_directories(path, threads):
+        for filepath in images:
+            yield filepath
+
+def find_image_directories(path, threads=__WALK_THREADS__):
+    """Searches a directory for JPEG 2000 images, yielding a (directory,
+    images) tuple for each directory in the file-tree as it is listed"""
+    if threads > 1:
+        for result in _find_images_parallel(path, threads):
+            yield result
+        return
+
     for root, dirs, files in os.walk(path):
-        for file_ in files:
-            if file_.endswith('.jp2'):
-                images.append(os.path.join(root, file_))
+        yield root, [os.path.join(root, file_) for file_ in files
+                     if file_.endswith('.jp2')]
 
-    return images
+def _find_images_parallel(path, threads):
+    """Traverses a file-tree using a pool of threads, each of which lists a
+    single directory at a time.
 
-def process_jp2_images (images, root_dir, cursor, mysql=True, step_fxn=None):
-    '''Processes a collection of JPEG 2000 Images'''
-    if mysql:
-        import MySQLdb
+    Listing latency rather than throughput dominates on network storage, so
+    the archive (nickname/YYYY/MM/DD/measurement) is split into one job per
+    directory as soon as each level has been listed. At most two jobs per
+    thread are in progress at a time so that memory use stays flat.
+    """
+    pool = ThreadPool(threads)
+    results = Queue.Queue()
+    directories = deque([path])
+    pending = 0
+
+    try:
+        while pending > 0 or len(directories) > 0:
+            while len(directories) > 0 and pending < 2 * threads:
+                pool.apply_async(_list_directory, (directories.popleft(),),
+                                 callback=results.put)
+                pending += 1
+
+            directory, images, subdirs = results.get()
+            pending -= 1
+
+            directories.extend(subdirs)
+
+            yield directory, images
+    finally:
+        pool.terminate()
+
+def _list_directory(path):
+    """Returns a directory, its JPEG 2000 images and its subdirectories.
+
+    Only entries which are not JPEG 2000 images are stat'd. Symbolic links to
+    directories are not followed (as with os.walk). Directories which cannot
+    be read are skipped.
+    """
+    images = []
+    subdirs = []
+
+    try:
+        names = os.listdir(path)
+    except OSError, e:
+        logging.warning("Unable to list %s: %s", path, e)
+        return path, images, subdirs
+
+    for name in names:
+        filepath = os.path.join(path, name)
+
+        if name.endswith('.jp2'):
+            images.append(filepath)
+            continue
+
+        try:
+            if stat.S_ISDIR(os.lstat(filepath).st_mode):
+                subdirs.append(filepath)
+        except OSError:
+            pass
+
+    return path, images, subdirs
+
+def find_image_batches(path, size=__IMAGES_PER_BATCH__,
+                       threads=__WALK_THREADS__, exclude=()):
+    """Searches a directory for JPEG 2000 images in batches.
+
+    Yields (filepaths, directories) tuples as soon as size images have been
+    found, where directories are those whose images have all been included
+    in this or an earlier batch. Once a batch has been processed, its
+    directories can be recorded as complete (see helioviewer.journal). Only
+    one batch is held in memory at a time.
+
+    Images in directories which are in exclude are skipped.
+    """
+    batch = []
+    completed = []
+
+    for directory, images in find_image_directories(path, threads):
+        if len(images) == 0 or directory in exclude:
+            continue
+
+        for filepath in images:
+            batch.append(filepath)
+
+            if len(batch) >= size:
+                yield batch, completed
+                batch = []
+                completed = []
+
+        completed.append(directory)
+
+    if len(batch) > 0 or len(completed) > 0:
+        yield batch, completed
+
+def filter_new_images(cursor, filepaths):
+    """Returns the images which are not yet in the images table. The whole
+    batch is checked using a bulk set difference rather than one query per
+    image (see helioviewer.db.get_new_filenames)."""
+    new = get_new_filenames(cursor, [os.path.basename(filepath)
+                                     for filepath in filepaths],
+                            include_corrupt=False)
+
+    return [filepath for filepath in filepaths
+            if os.path.basename(filepath) in new]
+
+def parse_filename(filename):
+    """Returns the date, observatory, instrument, detector and measurement
+    of an image from its filename, or None if the filename is not in the
+    standard format. Observatories with a hyphen in the filename have an
+    underscore in their name, e.g. STEREO-A -> STEREO_A."""
+    match = __FILENAME_REGEX__.match(os.path.basename(filename))
+
+    if match is None:
+        return None
+
+    fields = match.groupdict()
+
+    try:
+        date = datetime.datetime(
+            int(fields['year']), int(fields['month']), int(fields['day']),
+            int(fields['hour']), int(fields['min']), int(fields['sec']),
+            int(fields['microsec'].ljust(6, "0")))
+    except ValueError:
+        return None
+
+    return {
+        "date": date,
+        "observatory": fields['obs'].replace("-", "_"),
+        "instrument": fields['inst'],
+        "detector": fields['det'],
+        "measurement": fields['meas']
+    }
+
+def read_image_params(filepaths, pool=None):
+    """Returns the parameters needed to add a collection of JPEG 2000 images
+    to the database (date, observatory, instrument, detector and
+    measurement).
+
+    The parameters are taken from the filename of each image where possible.
+    Only the headers of images whose filenames are not in the standard format
+    are parsed (see read_headers). Images are not validated.
+    """
+    results = [parse_filename(filepath) for filepath in filepaths]
+
+    # Fall back on the image headers
+    missing = [i for i, params in enumerate(results) if params is None]
+
+    if len(missing) > 0:
+        headers = read_headers([filepaths[i] for i in missing], pool=pool)
+
+        for i, params in zip(missing, headers):
+            results[i] = params
+
+    return results
+
+def read_headers(filepaths, validate=False, pool=None):
+    """Parses the headers of a collection of JPEG 2000 images
+
+    Parameters
+    ----------
+    filepaths : list
+        list of JPEG 2000 images to parse
+    validate : bool
+        whether or not images that are known to have problems should be
+        rejected (see validate_image)
+    pool : multiprocessing.Pool
+        (optional) pool of worker processes to parse the headers with
+
+    Returns
+    -------
+    out : list
+        image parameters for each file, in the same order as filepaths. Images
+        that could not be parsed or which failed validation are represented
+        by a BadImage instance instead.
+    """
+    jobs = [(filepath, validate) for filepath in filepaths]
+
+    if pool is None:
+        results = [_read_header_job(job) for job in jobs]
     else:
-        import pgdb
+        results = pool.map(_read_header_job, jobs)
+
+    # Exceptions do not survive pickling so errors are passed back as strings
+    return [BadImage(x) if isinstance(x, basestring) else x for x in results]
+
+def _read_header_job(job):
+    """Parses and validates a single image header, returning the error message
+    if the image is bad"""
+    filepath, validate = job
+
+    try:
+        try:
+            image_params = read_header(filepath)
+        except:
+            raise BadImage("HEADER")
+
+        if validate:
+            validate_image(image_params)
+    except BadImage, e:
+        return e.get_message()
+
+    return image_params
+
+def read_header(filepath):
+    """Returns the image parameters (date, observatory, instrument, detector,
+    measurement, nickname and FITS header) for a JPEG 2000 image
+
+    The FITS header is read directly from the image's XML box. Images from
+    instruments which are not recognized, or whose XML box cannot be read,
+    are parsed using sunpy instead.
+    """
+    try:
+        return read_xml_header(filepath)
+    except (EnvironmentError, ValueError, KeyError):
+        import sunpy
+        return sunpy.read_header(filepath)
+
+def read_xml_header(filepath):
+    """Reads the image parameters for a JPEG 2000 image from its XML box"""
+    xml = get_xml_box(filepath)
+
+    if xml is None:
+        raise ValueError("%s: no XML box found" % filepath)
+
+    header = parse_fits_xml(xml)
+
+    params = get_image_properties(header)
+    params['header'] = header
+
+    return params
+
+def get_xml_box(filepath):
+    """Returns the contents of the first XML box in a JPEG 2000 image, or
+    None if there is not one. The file is memory-mapped so that only the
+    box headers and the XML box itself are read from disk."""
+    fp = open(filepath, "rb")
+
+    try:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fp.close()
+
+    try:
+        return _find_box(data, 0, len(data), "xml ")
+    finally:
+        data.close()
+
+def _find_box(data, start, end, box_type):
+    """Walks the JP2 boxes between start and end, descending into
+    association boxes, and returns the contents of the first box of the
+    requested type"""
+    offset = start
+
+    while offset + 8 <= end:
+        length, tbox = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+
+        # Box extends to the end of the file or has an extended length
+        if length == 0:
+            length = end - offset
+        elif length == 1:
+            length = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+
+        if length < header_size or offset + length > end:
+            raise ValueError("Invalid JP2 box length at offset %d" % offset)
+
+        if tbox == box_type:
+            return data[offset + header_size:offset + length]
+
+        if tbox == "asoc":
+            contents = _find_box(data, offset + header_size, offset + length,
+                                 box_type)
+            if contents is not None:
+                return contents
+
+        offset += length
 
-    # Return tree of known data-sources
-    sources = get_datasources(cursor)
+    return None
+
+def parse_fits_xml(xml):
+    """Extracts the FITS keywords from the XML box of a JPEG 2000 image"""
+    match = __FITS_SECTION_REGEX__.search(xml)
+
+    if match is not None:
+        xml = match.group(1)
+
+    header = FITSHeader()
+
+    for key, value in __FITS_REGEX__.findall(xml):
+        header[key] = _parse_fits_value(value)
+
+    return header
+
+def _parse_fits_value(value):
+    """Converts a FITS keyword value to an int or float where possible"""
+    value = value.strip()
+
+    if "&" in value:
+        for entity, char in __XML_ENTITIES__:
+            value = value.replace(entity, char)
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def get_image_properties(header):
+    """Returns the date, observatory, instrument, detector, measurement and
+    nickname for an image, using the conventions for its instrument.
+
+    A KeyError is raised if the instrument is not recognized.
+    """
+    instrument = str(header.get('INSTRUME', '')).upper()
+    detector = str(header.get('DETECTOR', '')).upper()
+
+    # SDO/AIA (INSTRUME=AIA_3) and SDO/HMI (INSTRUME=HMI_FRONT2)
+    if instrument.startswith("AIA"):
+        props = ("SDO", "AIA", "AIA", _get_wavelength(header), "AIA")
+    elif instrument.startswith("HMI"):
+        props = ("SDO", "HMI", "HMI",
+                 _get_magnetogram_or_continuum(header.get('CONTENT')), "HMI")
+    elif instrument == "EIT":
+        props = ("SOHO", "EIT", "EIT", _get_wavelength(header), "EIT")
+    elif instrument == "LASCO" and detector in ["C2", "C3"]:
+        props = ("SOHO", "LASCO", detector, "white-light", "LASCO-" + detector)
+    elif instrument == "MDI":
+        props = ("SOHO", "MDI", "MDI",
+                 _get_magnetogram_or_continuum(header.get('DPC_OBSR')), "MDI")
+    elif instrument == "SECCHI" and detector in ["EUVI", "COR1", "COR2"]:
+        observatory = str(header['OBSRVTRY']).upper()
+
+        if observatory not in ["STEREO_A", "STEREO_B"]:
+            raise KeyError(observatory)
+
+        nickname = "%s-%s" % (detector, observatory[-1])
+
+        if detector == "EUVI":
+            measurement = _get_wavelength(header)
+        else:
+            measurement = "white-light"
+
+        props = (observatory, "SECCHI", detector, measurement, nickname)
+    elif instrument == "SWAP":
+        props = ("PROBA2", "SWAP", "SWAP", _get_wavelength(header), "SWAP")
+    else:
+        raise KeyError(instrument)
+
+    observatory, instrument, detector, measurement, nickname = props
+
+    return {
+        "date": _get_observation_date(header),
+        "observatory": observatory,
+        "instrument": instrument,
+        "detector": detector,
+        "measurement": measurement,
+        "nickname": nickname
+    }
+
+def _get_wavelength(header):
+    """Returns the wavelength of an image, e.g. 304"""
+    wavelength = header['WAVELNTH']
+
+    if isinstance(wavelength, float) and wavelength.is_integer():
+        return int(wavelength)
+
+    return wavelength
+
+def _get_magnetogram_or_continuum(content):
+    """Determines the measurement for an HMI or MDI image from a description
+    of its contents, e.g. "FD_Magnetogram_Sum" """
+    content = str(content).upper()
+
+    if "MAG" in content:
+        return "magnetogram"
+    elif "CONT" in content or "INTENSITY" in content:
+        return "continuum"
+
+    raise KeyError(content)
+
+def _get_observation_date(header):
+    """Returns the observation date for an image. Some instruments store the
+    date and time of the observation separately."""
+    date = str(header['DATE_OBS']).strip().rstrip("Z").replace("/", "-")
+
+    if "T" not in date and "TIME_OBS" in header:
+        date += "T" + str(header['TIME_OBS']).strip().rstrip("Z")
+
+    # Fractional seconds may have more digits than strptime accepts
+    if "." in date:
+        date, fraction = date.split(".", 1)
+        microseconds = int(fraction[:6].ljust(6, "0"))
+    else:
+        microseconds = 0
+
+    date = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S")
+
+    return date.replace(microsecond=microseconds)
+
+class FITSHeader(dict):
+    """FITS header read from a JPEG 2000 image. Keywords may be looked up in
+    any case and with either a hyphen or an underscore, e.g. DATE-OBS,
+    date_obs."""
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, _normalize_key(key), value)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, _normalize_key(key))
+
+    def __contains__(self, key):
+        return dict.__contains__(self, _normalize_key(key))
+
+    def get(self, key, default=None):
+        return dict.get(self, _normalize_key(key), default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+def _normalize_key(key):
+    """Returns the form used to store a FITS keyword"""
+    return key.upper().replace("-", "_")
+
+def validate_image(params):
+    """Filters out images that are known to have problems using information
+    in their metadata"""
+
+    # Make sure the time can be understood
+    if not isinstance(params['date'], datetime.datetime):
+        from sunpy.time import is_time
+
+        if not is_time(params['date']):
+            raise BadImage("DATE")
+
+    # AIA
+    if params['detector'] == "AIA":
+        if params['header'].get("IMG_TYPE") == "DARK":
+            raise BadImage("DARK")
+        if float(params['header'].get('PERCENTD')) < 50:
+            raise BadImage("PERCENTD")
+        if str(params['header'].get('WAVE_STR')).endswith("_OPEN"):
+            raise BadImage("WAVE_STR")
+
+    # LASCO
+    if params['instrument'] == "LASCO":
+        hcomp_sf = params['header'].get('hcomp_sf')
+
+        if ((params['detector'] == "C2" and hcomp_sf == 32) or
+            (params['detector'] == "C3" and hcomp_sf == 64)):
+                raise BadImage("WrongMask")
+
+def process_jp2_images (images, root_dir, cursor, mysql=True, step_fxn=None,
+                        bulk=False, sources=None):
+    '''Processes a collection of JPEG 2000 Images
+
+    If bulk is True and MySQL is used, the images are loaded using LOAD DATA
+    LOCAL INFILE, falling back on regular inserts if the bulk load is not
+    permitted. The cursor must belong to a connection with local_infile
+    enabled (see get_db_cursor).
+
+    A DatasourceCache may be passed in to avoid reloading the datasources
+    each time images are processed.
+    '''
+    # Known data-sources
+    if sources is None:
+        sources = DatasourceCache()
+
+    rows = get_image_rows(images, sources, root_dir, cursor, step_fxn)
+
+    if bulk and mysql:
+        try:
+            _load_rows(rows, cursor)
+            return
+        except Exception, e:
+            logging.warning("Bulk load failed (%s). Falling back on regular "
+                            "inserts.", e)
 
     # Insert images into database, 500 at a time
-    while len(images) > 0:
-        subset = images[:__INSERTS_PER_QUERY__]
-        images = images[__INSERTS_PER_QUERY__:]
-        insert_images(subset, sources, root_dir, cursor, mysql, step_fxn)
+    while len(rows) > 0:
+        subset = rows[:__INSERTS_PER_QUERY__]
+        rows = rows[__INSERTS_PER_QUERY__:]
+        _insert_rows(subset, cursor, mysql)
     
 def insert_images(images, sources, rootdir, cursor, mysql, step_function=None):
-    """Inserts multiple images into a database using a single query
+    """Inserts multiple images into a database using a single parameterized
+    statement
     
     Parameters
     ----------    
     images : list
         list of image dict representations
-    sources : list
-        tree of datasources supported by Helioviewer
+    sources : DatasourceCache
+        datasources supported by Helioviewer
     rootdir : string
         image archive root directory
     cursor : mixed 
@@ -57,9 +569,24 @@ def insert_images(images, sources, rootdir, cursor, mysql, step_function=None):
     step_function : function
         function to call after each insert query
     """    
-    query = "INSERT IGNORE INTO images VALUES "
+    rows = get_image_rows(images, sources, rootdir, cursor, step_function)
+    _insert_rows(rows, cursor, mysql)
+
+def load_images(images, sources, rootdir, cursor, step_function=None):
+    """Bulk loads images into a MySQL database by streaming rows from a
+    temporary file using LOAD DATA LOCAL INFILE
+
+    Parameters are the same as for insert_images.
+    """
+    rows = get_image_rows(images, sources, rootdir, cursor, step_function)
+    _load_rows(rows, cursor)
+
+def get_image_rows(images, sources, rootdir, cursor, step_function=None):
+    """Returns a (filepath, filename, date, sourceId) row for each image,
+    enabling any datasources which do not yet have data using a single
+    query"""
+    rows = []
 
-    # Add images to SQL query
     for i, img in enumerate(images):
         # break up directory and filepath
         directory, filename = os.path.split(img['filepath'])
@@ -70,25 +597,64 @@ def insert_images(images, sources, rootdir, cursor, mysql, step_function=None):
         img["measurement"] = str(img["measurement"])
         
         # Data Source
-        source = sources[img["observatory"]][img["instrument"]][img["detector"]][img["measurement"]]
+        source = sources.get(cursor, img["observatory"], img["instrument"],
+                             img["detector"], img["measurement"])
         
         # Enable datasource if it has not already been
-        if (not source['enabled']):
-            sources[img["observatory"]][img["instrument"]][img["detector"]][img["measurement"]]["enabled"] = True
-            enable_datasource(cursor, source['id'])
+        sources.enable(source)
 
-        # insert into database
-        query += "(NULL, '%s', '%s', '%s', %d)," % (path, filename, img["date"], source['id'])
+        rows.append((path, filename, img["date"], source['id']))
     
         # Progressbar
         if step_function and (i + 1) % __STEP_FXN_THROTTLE__ is 0:
             step_function(filename)
-    
-    # Remove trailing comma
-    query = query[:-1] + ";"
-        
-    # Execute query
-    cursor.execute(query)
+
+    sources.flush(cursor)
+
+    return rows
+
+def _insert_rows(rows, cursor, mysql):
+    """Inserts rows returned by get_image_rows using a single parameterized
+    statement"""
+    if len(rows) == 0:
+        return
+
+    # MySQLdb sends executemany inserts as a single multi-row statement
+    if mysql:
+        sql = ("INSERT IGNORE INTO images (filepath, filename, date, sourceId) "
+               "VALUES (%s, %s, %s, %s)")
+    else:
+        sql = ("INSERT INTO images (filepath, filename, date, sourceId) "
+               "VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING")
+
+    cursor.executemany(sql, rows)
+
+def _load_rows(rows, cursor):
+    """Loads rows returned by get_image_rows into MySQL from a temporary
+    tab-separated file"""
+    if len(rows) == 0:
+        return
+
+    fp = tempfile.NamedTemporaryFile(suffix=".tsv")
+
+    try:
+        for path, filename, date, source_id in rows:
+            fp.write("%s\t%s\t%s\t%d\n" % (_escape_field(path),
+                                            _escape_field(filename),
+                                            date, source_id))
+        fp.flush()
+
+        cursor.execute(
+            "LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE images "
+            "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' "
+            "(filepath, filename, date, sourceId);", (fp.name,))
+    finally:
+        fp.close()
+
+def _escape_field(value):
+    """Escapes a value for use in a tab-separated LOAD DATA file"""
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+                 .replace("\n", "\\n"))
     
 class BadImage(ValueError):
     """Exception to raise when a "bad" image (e.g. corrupt or calibration) is
@@ -0,0 +1 @@
+"""Tests for the Helioviewer.org Python tools"""
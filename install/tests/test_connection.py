@@ -0,0 +1,84 @@
+"""Tests for helioviewer.hvpull.net.connection"""
+import unittest
+import threading
+import BaseHTTPServer
+import SocketServer
+from urllib2 import HTTPError
+from helioviewer.hvpull.net.connection import ConnectionPool
+
+class ListingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves a directory listing, answering conditional requests with a
+    304 which has neither a body nor a Content-Length"""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+
+        if self.headers.getheader("If-None-Match") == '"listing"':
+            self.send_response(304)
+            self.send_header("ETag", '"listing"')
+            self.end_headers()
+            return
+
+        body = '<a href="2011_11_17__00_00_01_34__SDO_AIA_AIA_304.jp2">'
+
+        self.send_response(200)
+        self.send_header("ETag", '"listing"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ListingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Server which handles each keep-alive connection in its own thread"""
+    daemon_threads = True
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ListingServer(("127.0.0.1", 0), ListingHandler)
+        self.server.clients = set()
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = "http://127.0.0.1:%d/AIA/" % self.server.server_port
+        self.key = ("http", "127.0.0.1:%d" % self.server.server_port)
+        self.pool = ConnectionPool(maxsize=2, timeout=5)
+
+    def tearDown(self):
+        for connections in self.pool._idle.values():
+            for conn in connections:
+                conn.close()
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse_after_read(self):
+        for i in range(3): #pylint: disable=W0612
+            response = self.pool.urlopen(self.url)
+            response.read()
+            response.close()
+
+        self.assertEqual(len(self.pool._idle.get(self.key, [])), 1)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_reuse_after_not_modified(self):
+        headers = {"If-None-Match": '"listing"'}
+
+        for i in range(3): #pylint: disable=W0612
+            try:
+                self.pool.urlopen(self.url, headers)
+            except HTTPError, e:
+                self.assertEqual(e.code, 304)
+            else:
+                self.fail("Expected a 304 response")
+
+            self.assertEqual(len(self.pool._idle.get(self.key, [])), 1)
+
+        self.assertEqual(len(self.server.clients), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Tests for helioviewer.jp2"""
+import datetime
+import unittest
+from helioviewer.db import DatasourceCache
+from helioviewer.jp2 import process_jp2_images
+
+class Cursor:
+    """Records the statements executed, refusing LOAD DATA LOCAL INFILE as a
+    server with local_infile disabled would"""
+    def __init__(self):
+        self.rows = []
+
+    def execute(self, sql, args=None):
+        raise Exception("The used command is not allowed with this MySQL "
+                        "version")
+
+    def executemany(self, sql, rows):
+        self.rows.extend(rows)
+
+class ProcessImagesTest(unittest.TestCase):
+    def setUp(self):
+        self.sources = DatasourceCache({("SDO", "AIA", "AIA", "304"):
+                                        {"id": 13, "enabled": True}})
+        self.images = []
+
+        for i in range(120):
+            self.images.append({
+                "filepath": "/var/www/jp2/AIA/304/%03d.jp2" % i,
+                "date": datetime.datetime(2011, 11, 17, 0, 0, i % 60),
+                "observatory": "SDO",
+                "instrument": "AIA",
+                "detector": "AIA",
+                "measurement": 304
+            })
+
+    def test_bulk_fallback(self):
+        cursor = Cursor()
+        steps = []
+
+        process_jp2_images(self.images, "/var/www/jp2", cursor,
+                           step_fxn=steps.append, bulk=True,
+                           sources=self.sources)
+
+        self.assertEqual(len(cursor.rows), len(self.images))
+        self.assertEqual(cursor.rows[0],
+                         ("/AIA/304", "000.jp2", self.images[0]["date"], 13))
+
+        # Progress is reported once per 50 images, not again on fallback
+        self.assertEqual(steps, ["049.jp2", "099.jp2"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""Tests for helioviewer.hvpull.net.workqueue"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from helioviewer.hvpull.net import workqueue
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = workqueue.WorkQueue(os.path.join(self.tmpdir, "queue.db"))
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _set_updated(self, filename, updated):
+        self.queue._db.execute("UPDATE files SET updated=? WHERE filename=?",
+                               (updated, filename))
+
+    def test_purge_removes_ingested(self):
+        self.queue.add("LMSAL", ["http://example.com/a.jp2",
+                                 "http://example.com/b.jp2"])
+        self.queue.set_state(["a.jp2"], workqueue.INGESTED)
+        self.queue.purge()
+
+        self.assertEqual(self.queue.get(workqueue.INGESTED), [])
+        self.assertEqual(self.queue.get(workqueue.DISCOVERED),
+                         [("LMSAL", "http://example.com/b.jp2", None)])
+
+    def test_purge_removes_expired_failures(self):
+        now = time.time()
+
+        self.queue.add("LMSAL", ["http://example.com/old.jp2",
+                                 "http://example.com/new.jp2"])
+        self.queue.set_state(["old.jp2", "new.jp2"], workqueue.FAILED)
+        self._set_updated("old.jp2", now - 7200)
+
+        self.queue.purge(now - 3600)
+
+        self.assertEqual(self.queue.get_failed().keys(), ["new.jp2"])
+
+    def test_failed_file_added_again(self):
+        self.queue.add("LMSAL", ["http://example.com/a.jp2"])
+        self.queue.set_state(["a.jp2"], workqueue.FAILED, note="corrupt")
+        self.queue.add("LMSAL", ["http://example.com/a.jp2"])
+
+        self.assertEqual(self.queue.get_failed(), {})
+        self.assertEqual(len(self.queue.get(workqueue.DISCOVERED)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
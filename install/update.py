@@ -5,8 +5,13 @@ Helioviewer Image Ingestion Tool
 Last Updated: 2012/03/08
 
 This script scans a specified directory for new JPEG 2000 images to be added
-to the Helioviewer.org archive. Any new images encountered are first moved
-to the archive and then added to the database.
+to the Helioviewer.org archive. Any new images encountered are first added to
+the database and then moved to the archive.
+
+Images are processed in batches. Directories whose images have all been
+processed are recorded in a journal (update.journal) so that an interrupted
+run can be resumed by running update.py again. Images which were added to the
+database but not moved before the interruption are moved when it is resumed.
 
 To periodically scan a directory for new images, you can simply create a cronjob
 to run update.py.
@@ -14,12 +19,17 @@ to run update.py.
 import sys
 import os
 import shutil
-import sunpy
-from helioviewer.jp2 import find_images, process_jp2_images
+import multiprocessing
+from helioviewer.jp2 import find_image_batches, process_jp2_images, \
+                            read_image_params, filter_new_images, BadImage
 from helioviewer.db  import get_db_cursor
+from helioviewer.journal import IngestJournal
 from helioviewer import init_logger
 from optparse import OptionParser, IndentedHelpFormatter
 
+# Record of completed directories, used to resume an interrupted run
+__JOURNAL__ = "update.journal"
+
 def main(argv):
     '''Main application access point'''
     options = get_options()
@@ -28,38 +38,83 @@ def main(argv):
     
     print('Processing Images...')
     
-    # Get a list of images to process
-    filepaths = find_images(options.source)
-    
-    if len(filepaths) is 0:
-        return
+    cursor = None
 
-    images = []
+    # Directories which were completed by an interrupted run
+    journal = IngestJournal(__JOURNAL__, options.source)
 
-    # Move images to main archive
-    for filepath in filepaths:
-        dest = os.path.join(options.destination, 
-                            os.path.relpath(filepath, options.source))
-        
-        # Parse image header
-        image_params = sunpy.read_header(filepath)
-        image_params['filepath'] = dest
-        
-        images.append(image_params)
+    if len(journal) > 0:
+        print("Resuming: skipping %d directories which have already been "
+              "processed." % len(journal))
 
-        directory = os.path.dirname(dest)
-        
-        if not os.path.isdir(directory):
-            os.makedirs(directory)
+    # Pool of processes to parse image headers with
+    pool = multiprocessing.Pool()
 
-        shutil.move(filepath, dest)
-    
-    # Add images to the database
-    cursor = get_db_cursor(options.dbname, options.dbuser, options.dbpass)
-    process_jp2_images(images, options.destination, cursor, True)    
-    cursor.close()
+    # Process images in batches as they are found
+    for filepaths, directories in find_image_batches(options.source,
+                                                     exclude=journal):
+        if cursor is None:
+            cursor = get_db_cursor(options.dbname, options.dbuser,
+                                   options.dbpass, local_infile=True)
+
+        # Images which are already in the database were left behind by an
+        # interrupted run and only need to be moved
+        new = filter_new_images(cursor, filepaths)
+        known = set(filepaths).difference(new)
+
+        images = []
+        moves = [(filepath, get_destination(filepath, options))
+                 for filepath in known]
+
+        # Read image parameters from the filenames, parsing the headers of
+        # any non-standard filenames in parallel
+        headers = read_image_params(new, pool)
+
+        for filepath, image_params in zip(new, headers):
+            if isinstance(image_params, BadImage):
+                print("Skipping corrupt image: %s" %
+                      os.path.basename(filepath))
+                continue
+
+            dest = get_destination(filepath, options)
+
+            image_params['filepath'] = dest
+            images.append(image_params)
+            moves.append((filepath, dest))
+
+        # Add images to the database before moving them to the archive
+        if len(images) > 0:
+            process_jp2_images(images, options.destination, cursor, True,
+                               bulk=True)
+
+        # Move images to main archive
+        for filepath, dest in moves:
+            move_image(filepath, dest)
+
+        # Checkpoint directories whose images are all in the archive
+        journal.commit(directories)
+
+    pool.close()
+    journal.finish()
+
+    if cursor is not None:
+        cursor.close()
     
     print('Finished!')
+
+def get_destination(filepath, options):
+    '''Returns the location in the archive to move an image to'''
+    return os.path.join(options.destination,
+                        os.path.relpath(filepath, options.source))
+
+def move_image(filepath, dest):
+    '''Moves an image to the archive'''
+    directory = os.path.dirname(dest)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    shutil.move(filepath, dest)
         
 def get_options():
     '''Gets command-line parameters'''